@@ -1,91 +1,493 @@
+import time
+
+# 启动耗时统计，从导入依赖开始计时
+startup_started_at = time.time()
+
+import asyncio
+import csv
+import difflib
+import hashlib
 import io
 import json
 import logging
+import operator
 import os
 import platform
-import subprocess
+import queue
+import re
+import tempfile
 import threading
-import time
 import zipfile
-from datetime import datetime
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from urllib.parse import quote
 import pytz
 
-import netmiko
-import pandas as pd
-from flask import Flask, jsonify, request, send_file, render_template
+# netmiko和openpyxl加载较慢，在第一次巡检或导入导出时才导入
+from flask import Flask, Response, jsonify, request, send_file, render_template, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import defer, load_only, selectinload
 from flask import send_from_directory
 
+# zstd压缩为可选依赖，未安装时使用zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+startup_timings = OrderedDict()
+
+def mark_startup_stage(stage):
+    """记录启动阶段完成时距启动开始的耗时（秒）"""
+    startup_timings[stage] = round(time.time() - startup_started_at, 3)
+
+mark_startup_stage('导入依赖')
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Device-Version'])
 
 # 配置数据库
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///network_inspection.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')  # WAL模式下读操作不会被写操作阻塞
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # WAL模式下NORMAL即可保证数据库不损坏
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 30000))  # 等待写锁的超时时间（毫秒）
+app.config['DB_WRITER_BATCH_SIZE'] = int(os.environ.get('DB_WRITER_BATCH_SIZE', 100))  # 后台写入队列合并提交的最大任务数
 db = SQLAlchemy(app)
 
+@db.event.listens_for(db.engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """每个新的SQLite连接设置日志模式、同步级别和忙等待超时"""
+    cursor = dbapi_connection.cursor()
+    # 只对新建的数据库立即生效，必须在设置WAL之前执行；已有的数据库需要通过/api/compaction/auto-vacuum转换一次
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT']}")
+    cursor.close()
+
+# 批量巡检并发配置
+app.config['BATCH_MAX_WORKERS'] = int(os.environ.get('BATCH_MAX_WORKERS', 20))  # 全局最大并发巡检数
+app.config['BATCH_GROUP_MAX_WORKERS'] = int(os.environ.get('BATCH_GROUP_MAX_WORKERS', 10))  # 单个分组最大并发巡检数
+app.config['BATCH_MAX_JOBS'] = int(os.environ.get('BATCH_MAX_JOBS', 4))  # 同时运行的批量巡检任务数
+
+# 设备状态检查配置
+app.config['STATUS_CHECK_INTERVAL'] = int(os.environ.get('STATUS_CHECK_INTERVAL', 30))  # 检查间隔（秒）
+app.config['STATUS_PROBE_METHOD'] = os.environ.get('STATUS_PROBE_METHOD', 'tcp')  # tcp：连接SSH/Telnet端口；ping：ICMP
+app.config['STATUS_PROBE_TIMEOUT'] = float(os.environ.get('STATUS_PROBE_TIMEOUT', 1))  # 单台设备探测超时（秒）
+app.config['STATUS_PROBE_CONCURRENCY'] = int(os.environ.get('STATUS_PROBE_CONCURRENCY', 200))  # 同时探测的设备数
+app.config['STATUS_FLUSH_INTERVAL'] = int(os.environ.get('STATUS_FLUSH_INTERVAL', 300))  # 状态未变化时刷新last_check的间隔（秒）
+
+# SSH/Telnet连接池配置
+app.config['CONNECTION_POOL_MAX_OPEN'] = int(os.environ.get('CONNECTION_POOL_MAX_OPEN', 50))  # 同时打开的会话上限
+app.config['CONNECTION_POOL_IDLE_TTL'] = int(os.environ.get('CONNECTION_POOL_IDLE_TTL', 300))  # 空闲会话保留时间（秒），0表示不复用
+
+# 巡检输出存储配置
+app.config['OUTPUT_COMPRESSION'] = os.environ.get('OUTPUT_COMPRESSION', 'zstd' if zstandard else 'zlib')  # zstd或zlib
+app.config['OUTPUT_COMPRESSION_LEVEL'] = int(os.environ.get('OUTPUT_COMPRESSION_LEVEL', 6))  # 压缩级别
+app.config['OUTPUT_SEARCH'] = int(os.environ.get('OUTPUT_SEARCH', 1))  # 是否为巡检输出建立全文索引，SQLite不支持FTS5时自动关闭
+app.config['SEARCH_MATCH_LINES'] = int(os.environ.get('SEARCH_MATCH_LINES', 5))  # 搜索结果中每条输出最多返回的匹配行数
+
+# 巡检历史保留策略 - 最近的记录全部保留，之后每台设备每天保留一条，再之后每周保留一条，超过期限的删除
+# 默认全部保留，需要清理时通过环境变量开启
+app.config['RETENTION_KEEP_ALL_DAYS'] = int(os.environ.get('RETENTION_KEEP_ALL_DAYS', 0))  # 保留全部巡检记录的天数，0表示不精简
+app.config['RETENTION_DAILY_DAYS'] = int(os.environ.get('RETENTION_DAILY_DAYS', 90))  # 每台设备每天保留一条记录的天数
+app.config['RETENTION_WEEKLY_DAYS'] = int(os.environ.get('RETENTION_WEEKLY_DAYS', 0))  # 巡检记录保留天数，超过后删除，0表示不删除
+app.config['RETENTION_LOG_DAYS'] = int(os.environ.get('RETENTION_LOG_DAYS', 0))  # 巡检日志保留天数，0表示不删除
+app.config['COMPACTION_INTERVAL'] = int(os.environ.get('COMPACTION_INTERVAL', 3600))  # 清理任务执行间隔（秒），0表示只在调用/api/compaction时执行
+app.config['COMPACTION_BATCH_SIZE'] = int(os.environ.get('COMPACTION_BATCH_SIZE', 200))  # 每个事务删除的记录数
+app.config['COMPACTION_VACUUM_PAGES'] = int(os.environ.get('COMPACTION_VACUUM_PAGES', 1000))  # 每批删除后最多回收的空闲页数
+
+# 批量导入导出配置
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))  # 每批导入并提交的设备数
+app.config['EXPORT_CHUNK_SIZE'] = int(os.environ.get('EXPORT_CHUNK_SIZE', 50))  # 每批加载的巡检记录数
+
 # 设置时区
 tz = pytz.timezone('Asia/Shanghai')
 
-# 设备模型
-class Device(db.Model):
+# 命令模板模型 - 多台设备共享同一套巡检命令
+# 设置了device_type/group的模板作为对应设备类型/分组的默认模板
+class CommandProfile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    ip = db.Column(db.String(100), nullable=False)
-    username = db.Column(db.String(100), nullable=False)
-    password = db.Column(db.String(100), nullable=False)
-    enable_password = db.Column(db.String(100), nullable=True)
-    device_type = db.Column(db.String(100), nullable=False)
-    protocol = db.Column(db.String(10), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True)
     commands = db.Column(db.Text, nullable=False)
-    status = db.Column(db.String(20), default='unknown')
-    last_check = db.Column(db.DateTime, nullable=True)
-    group = db.Column(db.String(50), default='交换机')  # 新增分组字段
+    device_type = db.Column(db.String(100), nullable=True)
+    group = db.Column(db.String(50), nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(tz), onupdate=lambda: datetime.now(tz))
 
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
-            'ip': self.ip,
-            'username': self.username,
-            'password': self.password,
-            'enable_password': self.enable_password,
-            'device_type': self.device_type,
-            'protocol': self.protocol,
             'commands': self.commands,
-            'status': self.status,
-            'last_check': self.last_check.isoformat() if self.last_check else None,
+            'device_type': self.device_type,
             'group': self.group,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+# 设备模型
+class Device(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    ip = db.Column(db.String(100), nullable=False, index=True)
+    username = db.Column(db.String(100), nullable=False)
+    password = db.Column(db.String(100), nullable=False)
+    enable_password = db.Column(db.String(100), nullable=True)
+    device_type = db.Column(db.String(100), nullable=False, index=True)
+    protocol = db.Column(db.String(10), nullable=False)
+    commands = db.Column(db.Text, nullable=False)  # 设备自定义命令，使用命令模板时可以为空
+    profile_id = db.Column(db.Integer, db.ForeignKey('command_profile.id'), nullable=True)  # 指定的命令模板
+    status = db.Column(db.String(20), default='unknown', index=True)
+    last_check = db.Column(db.DateTime, nullable=True)
+    group = db.Column(db.String(50), default='交换机', index=True)  # 新增分组字段
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+    version = db.Column(db.Integer, default=0, index=True)  # 最后一次变更时的设备表版本号
+
+    # to_dict支持的字段
+    # last_check只在状态变化时随版本号更新，定期刷新不递增版本号，最新值通过status_flush事件推送
+    FIELDS = (
+        'id', 'name', 'ip', 'username', 'password', 'enable_password', 'device_type', 'protocol',
+        'commands', 'profile_id', 'status', 'last_check', 'group', 'created_at', 'version'
+    )
+    # 分页列表默认返回的字段，不含密码和命令
+    LIST_FIELDS = (
+        'id', 'name', 'ip', 'username', 'device_type', 'protocol', 'profile_id',
+        'status', 'last_check', 'group', 'created_at', 'version'
+    )
+
+    def to_dict(self, fields=None):
+        data = {}
+        for field in fields or self.FIELDS:
+            value = getattr(self, field)
+            data[field] = value.isoformat() if isinstance(value, datetime) else value
+        return data
+
 # 巡检记录模型
 class InspectionRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
     device_name = db.Column(db.String(100), nullable=False)
-    result = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+    result = db.Column(db.Text, nullable=False)  # 旧版本的JSON结果，新记录为空，输出保存在outputs中
+    result_size = db.Column(db.Integer, nullable=True)  # 输出原始大小（字节）
+    status = db.Column(db.String(20), nullable=True)  # 成功/失败，旧记录为空
+    previous_record_id = db.Column(db.Integer, nullable=True)  # 计算差异时对比的上一条记录
+    changed_commands = db.Column(db.Integer, nullable=True)  # 与上一条记录相比输出有变化的命令数，没有上一条记录时为空
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz), index=True)
+
+    __table_args__ = (
+        db.Index('ix_inspection_record_device_created', 'device_id', 'created_at'),
+        db.Index('ix_inspection_record_created_changed', 'created_at', 'changed_commands'),
+    )
+
+    outputs = db.relationship(
+        'InspectionRecordOutput',
+        order_by='InspectionRecordOutput.position',
+        cascade='all, delete-orphan'
+    )
+    diffs = db.relationship(
+        'InspectionRecordDiff',
+        order_by='InspectionRecordDiff.position',
+        cascade='all, delete-orphan'
+    )
+    metrics = db.relationship('InspectionMetric', cascade='all, delete-orphan')
+
+    def set_results(self, command_results, success=None):
+        """按命令拆分输出，输出内容压缩后按哈希去重保存"""
+        self.result = ''
+        self.outputs = [
+            InspectionRecordOutput.build(position, item['command'], item['output'])
+            for position, item in enumerate(command_results)
+        ]
+        self.result_size = sum(len((item['output'] or '').encode('utf-8')) for item in command_results)
+        if success is not None:
+            self.status = '成功' if success else '失败'
+        # 解析得到的指标，同一指标出现多次时以最后一次为准
+        now = datetime.now(tz)
+        self.created_at = now
+        values = {}
+        for item in command_results:
+            values.update(item.get('metrics') or {})
+        self.metrics = [
+            InspectionMetric(device_id=self.device_id, metric=metric, value=value, created_at=now)
+            for metric, value in values.items()
+        ]
+
+    def get_results(self, blobs=None):
+        """巡检结果列表，旧版本的记录仍从result字段读取；blobs为预先加载的{哈希: 输出}"""
+        if self.result:
+            return json.loads(self.result)
+        if blobs is None:
+            blobs = OutputBlob.load_many([output.blob_hash for output in self.outputs])
+        return [
+            {'command': output.command, 'output': blobs[output.blob_hash]}
+            for output in self.outputs
+        ]
+
+    def to_summary_dict(self):
+        """记录元数据，不读取巡检输出"""
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'device_name': self.device_name,
+            'result_size': self.result_size,
+            'status': self.status,
+            'changed_commands': self.changed_commands,
+            'created_at': self.created_at.isoformat()
+        }
 
     def to_dict(self):
         return {
             'id': self.id,
             'device_id': self.device_id,
             'device_name': self.device_name,
-            'result': self.result,
+            'result': json.dumps(self.get_results(), ensure_ascii=False),
             'created_at': self.created_at.isoformat()
         }
 
+# 巡检记录中单条命令的输出 - 输出内容保存在按哈希共享的OutputBlob中
+class InspectionRecordOutput(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('inspection_record.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)  # 命令在记录中的顺序
+    command = db.Column(db.Text, nullable=False)
+    blob_hash = db.Column(db.String(64), nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('ix_inspection_record_output_record_position', 'record_id', 'position'),
+    )
+
+    @classmethod
+    def build(cls, position, command, output):
+        output_row = cls(position=position, command=command)
+        output_row.blob_hash, output_row.pending_blob = OutputBlob.pack(output)
+        output_row.pending_output = output or ''
+        return output_row
+
+# 巡检记录与同一设备上一条记录的逐命令差异 - 只保存有变化的命令，差异文本压缩保存
+class InspectionRecordDiff(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('inspection_record.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    command = db.Column(db.Text, nullable=False)
+    change_type = db.Column(db.String(10), nullable=False)  # changed/added/removed
+    added_lines = db.Column(db.Integer, nullable=False, default=0)
+    removed_lines = db.Column(db.Integer, nullable=False, default=0)
+    codec = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)  # 压缩后的unified diff
+
+    __table_args__ = (
+        db.Index('ix_inspection_record_diff_record_position', 'record_id', 'position'),
+    )
+
+    def to_dict(self):
+        return {
+            'command': self.command,
+            'change_type': self.change_type,
+            'added_lines': self.added_lines,
+            'removed_lines': self.removed_lines,
+            'diff': OutputBlob.unpack(self.codec, self.data)
+        }
+
+# 从巡检输出解析出的指标 - 每条巡检记录每个指标一行，用于查询指标历史
+class InspectionMetric(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('inspection_record.id'), nullable=False, index=True)
+    device_id = db.Column(db.Integer, nullable=False)
+    metric = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_inspection_metric_device_metric_created', 'device_id', 'metric', 'created_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'record_id': self.record_id,
+            'metric': self.metric,
+            'value': self.value,
+            'created_at': self.created_at.isoformat()
+        }
+
+# 每台设备每个指标的最新值 - 全网指标查询（如CPU > 80%）只需一次(metric, value)索引范围查找
+class DeviceMetric(db.Model):
+    device_id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Float, nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_device_metric_metric_value', 'metric', 'value'),
+    )
+
+# 健康检查规则 - threshold规则比较解析出的指标，pattern规则匹配命令输出；
+# 设置了group/device_type的规则只对对应分组/设备类型的设备生效
+class HealthRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    rule_type = db.Column(db.String(20), nullable=False)  # threshold/pattern
+    severity = db.Column(db.String(10), nullable=False, default='警告')  # 警告/严重
+    group = db.Column(db.String(50), nullable=True)
+    device_type = db.Column(db.String(100), nullable=True)
+    metric = db.Column(db.String(50), nullable=True)  # threshold规则的指标名
+    operator = db.Column(db.String(2), nullable=True)  # > >= < <= == !=
+    threshold = db.Column(db.Float, nullable=True)
+    command_pattern = db.Column(db.String(200), nullable=True)  # pattern规则匹配的命令（正则），为空时匹配所有命令
+    pattern = db.Column(db.String(500), nullable=True)  # pattern规则在输出中查找的正则
+    match = db.Column(db.String(10), nullable=False, default='present')  # present：找到时告警；absent：找不到时告警
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(tz), onupdate=lambda: datetime.now(tz))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'rule_type': self.rule_type,
+            'severity': self.severity,
+            'group': self.group,
+            'device_type': self.device_type,
+            'metric': self.metric,
+            'operator': self.operator,
+            'threshold': self.threshold,
+            'command_pattern': self.command_pattern,
+            'pattern': self.pattern,
+            'match': self.match,
+            'enabled': self.enabled,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+# 压缩后的命令输出 - 以内容的sha256为主键，相同输出只保存一份
+class OutputBlob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.String(10), nullable=False)  # zlib/zstd
+    size = db.Column(db.Integer, nullable=False)  # 原始大小（字节）
+    stored_size = db.Column(db.Integer, nullable=False)  # 压缩后大小（字节）
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @staticmethod
+    def pack(output):
+        """返回(哈希, 待写入的行数据)"""
+        raw = (output or '').encode('utf-8')
+        digest = hashlib.sha256(raw).hexdigest()
+        codec = app.config['OUTPUT_COMPRESSION']
+        level = app.config['OUTPUT_COMPRESSION_LEVEL']
+        if codec == 'zstd' and zstandard:
+            data = zstandard.ZstdCompressor(level=level).compress(raw)
+        else:
+            codec = 'zlib'
+            data = zlib.compress(raw, level)
+        return digest, {
+            'hash': digest,
+            'codec': codec,
+            'size': len(raw),
+            'stored_size': len(data),
+            'data': data
+        }
+
+    @staticmethod
+    def unpack(codec, data):
+        if codec == 'zstd':
+            if not zstandard:
+                raise RuntimeError('巡检输出使用zstd压缩，请安装zstandard')
+            raw = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            raw = zlib.decompress(data)
+        return raw.decode('utf-8')
+
+    @classmethod
+    def load_many(cls, hashes):
+        """一次查询解压多个输出，返回{哈希: 输出}"""
+        hashes = list(set(hashes))
+        if not hashes:
+            return {}
+        rows = db.session.query(cls.hash, cls.codec, cls.data).filter(cls.hash.in_(hashes)).all()
+        return {row.hash: cls.unpack(row.codec, row.data) for row in rows}
+
+    @classmethod
+    def delete_unreferenced(cls, hashes):
+        """删除不再被任何巡检记录引用的输出，同时从全文索引中移除"""
+        hashes = list(set(hashes))
+        if not hashes:
+            return 0
+        referenced = db.session.query(InspectionRecordOutput.blob_hash)\
+            .filter(InspectionRecordOutput.blob_hash.in_(hashes))
+        unreferenced = [hash for (hash,) in db.session.query(cls.hash)
+                        .filter(cls.hash.in_(hashes), ~cls.hash.in_(referenced)).all()]
+        if not unreferenced:
+            return 0
+        unindex_output_blobs(db.session, unreferenced)
+        return cls.query.filter(cls.hash.in_(unreferenced)).delete(synchronize_session=False)
+
+# 全文索引中的输出 - id即output_fts的rowid，显式的整数主键在VACUUM后保持不变
+class OutputSearchEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    blob_hash = db.Column(db.String(64), nullable=False, unique=True)
+
+# 巡检输出全文索引 - FTS5无内容表，只保存倒排索引不保存原文，相同输出只索引一次
+# SQLite 3.43之前的无内容表删除时必须提供原文，因此删除前先解压输出
+OUTPUT_SEARCH_TABLE_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS output_fts USING fts5(content, content='')"
+
+def output_search_table_exists():
+    return bool(db.session.execute(
+        db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'output_fts'")
+    ).scalar())
+
+def index_output_blobs(session, outputs):
+    """把输出加入全文索引，outputs为{哈希: 输出}，已索引的输出跳过"""
+    if not app.config['OUTPUT_SEARCH'] or not outputs:
+        return 0
+    entry_table = OutputSearchEntry.__table__
+    indexed = set(hash for (hash,) in session.execute(
+        db.select([entry_table.c.blob_hash]).where(entry_table.c.blob_hash.in_(list(outputs)))
+    ))
+    new_hashes = [hash for hash in outputs if hash not in indexed]
+    if not new_hashes:
+        return 0
+    session.execute(entry_table.insert(), [{'blob_hash': hash} for hash in new_hashes])
+    entries = session.execute(
+        db.select([entry_table.c.id, entry_table.c.blob_hash]).where(entry_table.c.blob_hash.in_(new_hashes))
+    ).all()
+    session.execute(
+        db.text('INSERT INTO output_fts(rowid, content) VALUES (:rowid, :content)'),
+        [{'rowid': entry.id, 'content': outputs[entry.blob_hash]} for entry in entries]
+    )
+    return len(entries)
+
+def unindex_output_blobs(session, hashes):
+    """从全文索引中移除输出，必须在删除output_blob之前调用"""
+    if not app.config['OUTPUT_SEARCH'] or not hashes:
+        return 0
+    entries = session.query(OutputSearchEntry.id, OutputBlob.codec, OutputBlob.data)\
+        .join(OutputBlob, OutputBlob.hash == OutputSearchEntry.blob_hash)\
+        .filter(OutputSearchEntry.blob_hash.in_(hashes)).all()
+    if not entries:
+        return 0
+    session.execute(
+        db.text("INSERT INTO output_fts(output_fts, rowid, content) VALUES ('delete', :rowid, :content)"),
+        [{'rowid': entry.id, 'content': OutputBlob.unpack(entry.codec, entry.data)} for entry in entries]
+    )
+    session.query(OutputSearchEntry).filter(OutputSearchEntry.id.in_([entry.id for entry in entries]))\
+        .delete(synchronize_session=False)
+    return len(entries)
+
 # 巡检日志模型 - 新增
 class InspectionLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    start_time = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(tz))
+    start_time = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(tz), index=True)
     end_time = db.Column(db.DateTime, nullable=True)
     total_devices = db.Column(db.Integer, default=0)
     successful_devices = db.Column(db.Integer, default=0)
@@ -94,7 +496,24 @@ class InspectionLog(db.Model):
     details = db.Column(db.Text, nullable=True)  # JSON格式存储详情
     status = db.Column(db.String(20), default='进行中')  # 进行中/已完成/已取消
 
-    def to_dict(self):
+    __table_args__ = (
+        db.Index('ix_inspection_log_status_start', 'status', 'start_time'),
+    )
+
+    devices = db.relationship(
+        'InspectionLogDevice',
+        order_by='InspectionLogDevice.position',
+        cascade='all, delete-orphan'
+    )
+
+    def get_details(self):
+        """设备巡检详情，旧版本的日志仍从details字段读取"""
+        if self.details:
+            return json.loads(self.details)
+        return [log_device.to_dict() for log_device in self.devices]
+
+    def to_summary_dict(self):
+        """日志摘要，只包含计数和时间，不读取设备详情"""
         return {
             'id': self.id,
             'start_time': self.start_time.isoformat() if self.start_time else None,
@@ -103,15 +522,354 @@ class InspectionLog(db.Model):
             'successful_devices': self.successful_devices,
             'failed_devices': self.failed_devices,
             'total_duration': self.total_duration,
-            'details': json.loads(self.details) if self.details else [],
             'status': self.status
         }
 
+    def to_dict(self):
+        data = self.to_summary_dict()
+        data['details'] = self.get_details()
+        return data
+
+# 巡检日志中单台设备的巡检进度 - 每台设备一行，更新进度时只修改对应的行
+class InspectionLogDevice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    log_id = db.Column(db.Integer, db.ForeignKey('inspection_log.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)  # 设备在日志中的顺序
+    device_id = db.Column(db.Integer, nullable=False)
+    device_name = db.Column(db.String(100), nullable=False)
+    device_ip = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='等待中')
+    message = db.Column(db.Text, nullable=True)
+    start_time = db.Column(db.DateTime, nullable=True)
+    end_time = db.Column(db.DateTime, nullable=True)
+    duration = db.Column(db.Float, nullable=True)
+    verdict = db.Column(db.String(10), nullable=True)  # 健康检查结论：正常/警告/严重，巡检失败时为空
+    findings = db.Column(db.Text, nullable=True)  # JSON格式的异常项列表
+
+    __table_args__ = (
+        db.Index('ix_inspection_log_device_log_device', 'log_id', 'device_id'),
+        db.Index('ix_inspection_log_device_log_position', 'log_id', 'position'),
+    )
+
+    def mark(self, status, message):
+        self.status = status
+        self.message = message
+        self.end_time = datetime.now(tz)
+
+    def to_dict(self):
+        data = {
+            'device_id': self.device_id,
+            'device_name': self.device_name,
+            'device_ip': self.device_ip,
+            'status': self.status,
+            'message': self.message,
+            'start_time': self.start_time.isoformat() if self.start_time else None,
+            'end_time': self.end_time.isoformat() if self.end_time else None
+        }
+        if self.duration is not None:
+            data['duration'] = self.duration
+        if self.verdict is not None:
+            data['verdict'] = self.verdict
+            data['findings'] = json.loads(self.findings) if self.findings else []
+        return data
+
+# 变更版本计数器 - 每个修改设备表的事务递增一次，用于ETag和增量同步
+class SyncCounter(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# 已删除设备记录 - 增量同步时告知客户端哪些设备被删除
+class DeviceTombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+
+# 设备状态变化历史 - 只记录状态切换，便于分析设备抖动
+class DeviceStatusHistory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index('ix_device_status_history_device_changed', 'device_id', 'changed_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'status': self.status,
+            'changed_at': self.changed_at.isoformat()
+        }
+
+def diff_with_previous_record(record, command_results):
+    """与同一设备的上一条记录逐命令比较，填充record的差异
+
+    输出哈希相同的命令直接跳过，只有哈希不同的命令才读取上一条记录的输出并计算差异。
+    """
+    try:
+        previous = InspectionRecord.query.options(selectinload(InspectionRecord.outputs))\
+            .filter(InspectionRecord.device_id == record.device_id)\
+            .order_by(InspectionRecord.created_at.desc(), InspectionRecord.id.desc()).first()
+        if previous is None:
+            return
+
+        # 同一命令执行多次时按出现顺序配对
+        def keyed(items):
+            counts = {}
+            result = OrderedDict()
+            for command, value in items:
+                counts[command] = counts.get(command, 0) + 1
+                result[(command, counts[command])] = value
+            return result
+
+        if previous.result:
+            # 旧版本的记录没有输出哈希，直接读取全部输出
+            previous_outputs = keyed((item['command'], item['output']) for item in json.loads(previous.result))
+            previous_hashes = OrderedDict(
+                (key, hashlib.sha256((output or '').encode('utf-8')).hexdigest())
+                for key, output in previous_outputs.items()
+            )
+        else:
+            previous_outputs = None
+            previous_hashes = keyed((output.command, output.blob_hash) for output in previous.outputs)
+        current_hashes = keyed((output.command, output.blob_hash) for output in record.outputs)
+        current_outputs = keyed((item['command'], item['output']) for item in command_results)
+
+        changed_keys = [key for key in current_hashes if previous_hashes.get(key) != current_hashes[key]]
+        changed_keys += [key for key in previous_hashes if key not in current_hashes]
+        if previous_outputs is None:
+            blobs = OutputBlob.load_many([previous_hashes[key] for key in changed_keys if key in previous_hashes])
+            previous_outputs = {key: blobs[previous_hashes[key]] for key in changed_keys if key in previous_hashes}
+
+        diffs = []
+        for position, key in enumerate(changed_keys):
+            old_lines = (previous_outputs.get(key) or '').splitlines() if key in previous_hashes else []
+            new_lines = (current_outputs.get(key) or '').splitlines() if key in current_hashes else []
+            diff_lines = list(difflib.unified_diff(old_lines, new_lines, 'previous', 'current', lineterm=''))
+            _, packed = OutputBlob.pack('\n'.join(diff_lines))
+            diffs.append(InspectionRecordDiff(
+                position=position,
+                command=key[0],
+                change_type='changed' if key in previous_hashes and key in current_hashes else ('added' if key in current_hashes else 'removed'),
+                added_lines=sum(1 for line in diff_lines if line.startswith('+') and not line.startswith('+++')),
+                removed_lines=sum(1 for line in diff_lines if line.startswith('-') and not line.startswith('---')),
+                codec=packed['codec'],
+                data=packed['data']
+            ))
+        record.previous_record_id = previous.id
+        record.changed_commands = len(diffs)
+        record.diffs = diffs
+    except Exception as e:
+        # 差异计算失败不影响保存巡检记录
+        logger.error(f"计算设备 {record.device_name} 的巡检差异失败: {str(e)}")
+
+# 数据库结构版本 - 记录已执行的迁移，db.create_all只创建新表，已有的表结构由迁移升级
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=lambda: datetime.now(tz))
+
+def add_columns(table_name, *column_names):
+    """为已存在的表补充列，列定义取自模型，列已存在时跳过"""
+    table = db.metadata.tables[table_name]
+    existing_columns = set(column['name'] for column in db.inspect(db.engine).get_columns(table_name))
+    for column_name in column_names:
+        if column_name in existing_columns:
+            continue
+        column_type = table.c[column_name].type.compile(dialect=db.engine.dialect)
+        db.session.execute(db.text(f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {column_type}'))
+        logger.info(f"数据表 {table_name} 新增列 {column_name}")
+
+def create_indexes(*index_names):
+    """创建模型中定义的索引，索引已存在时跳过"""
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    for index_name in index_names:
+        indexes[index_name].create(bind=db.session.connection(), checkfirst=True)
+
+def migrate_device_and_record_columns():
+    add_columns('device', 'profile_id', 'version')
+    add_columns('inspection_record', 'result_size', 'status')
+    # 为旧版本的巡检记录补充输出大小
+    InspectionRecord.query.filter(InspectionRecord.result_size.is_(None), InspectionRecord.result != '')\
+        .update({'result_size': db.func.length(InspectionRecord.result)}, synchronize_session=False)
+
+def migrate_hot_query_indexes():
+    create_indexes(
+        'ix_device_ip',
+        'ix_device_device_type',
+        'ix_device_status',
+        'ix_device_group',
+        'ix_device_version',
+        'ix_inspection_record_created_at',
+        'ix_inspection_record_device_created',
+        'ix_inspection_log_start_time',
+        'ix_inspection_log_status_start'
+    )
+
+def migrate_record_diff_columns():
+    add_columns('inspection_record', 'previous_record_id', 'changed_commands')
+    create_indexes('ix_inspection_record_created_changed')
+
+def migrate_log_device_verdict_columns():
+    add_columns('inspection_log_device', 'verdict', 'findings')
+
+def migrate_output_search_index():
+    # 已有的输出由init_output_search补建索引
+    try:
+        db.session.execute(db.text(OUTPUT_SEARCH_TABLE_SQL))
+    except Exception as e:
+        logger.warning(f"当前SQLite不支持FTS5，巡检输出全文搜索不可用: {str(e)}")
+
+# 按版本号顺序执行的迁移，新的表结构变化追加到末尾，已发布的迁移不要修改
+SCHEMA_MIGRATIONS = [
+    (1, '设备表新增命令模板和版本号列，巡检记录表新增输出大小和状态列', migrate_device_and_record_columns),
+    (2, '为设备、巡检记录和巡检日志的常用查询列添加索引', migrate_hot_query_indexes),
+    (3, '巡检记录表新增上一条记录和变化命令数列', migrate_record_diff_columns),
+    (4, '巡检日志设备表新增健康检查结论列', migrate_log_device_verdict_columns),
+    (5, '为巡检输出建立全文索引', migrate_output_search_index),
+]
+
+def run_schema_migrations():
+    """执行尚未执行的迁移，每个迁移在单独的事务中完成"""
+    applied = set(version for (version,) in db.session.query(SchemaMigration.version).all())
+    for version, name, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            migrate()
+            db.session.add(SchemaMigration(version=version, name=name))
+            db.session.commit()
+            logger.info(f"数据库迁移 {version} 完成: {name}")
+        except Exception:
+            db.session.rollback()
+            logger.error(f"数据库迁移 {version} 失败: {name}")
+            raise
+
+def init_device_version():
+    """初始化设备表版本计数器，旧数据统一视为版本1"""
+    if not SyncCounter.query.get('device'):
+        max_version = db.session.query(db.func.max(Device.version)).scalar() or 0
+        db.session.add(SyncCounter(name='device', value=max(max_version, 1)))
+    Device.query.filter(db.or_(Device.version.is_(None), Device.version == 0))\
+        .update({'version': 1}, synchronize_session=False)
+    db.session.commit()
+
+def init_output_search():
+    """检查全文索引是否可用，并为尚未索引的输出补建索引
+
+    升级前保存的输出和关闭全文索引期间写入的输出都在这里补齐，按批提交，避免一次解压全部输出。
+    """
+    if not app.config['OUTPUT_SEARCH']:
+        return
+    if not output_search_table_exists():
+        app.config['OUTPUT_SEARCH'] = 0
+        logger.warning("巡检输出全文索引不存在，全文搜索已关闭")
+        return
+    indexed = db.session.query(OutputSearchEntry.blob_hash)
+    total = 0
+    while True:
+        rows = db.session.query(OutputBlob.hash, OutputBlob.codec, OutputBlob.data)\
+            .filter(~OutputBlob.hash.in_(indexed)).limit(app.config['EXPORT_CHUNK_SIZE']).all()
+        if not rows:
+            break
+        total += index_output_blobs(db.session, {row.hash: OutputBlob.unpack(row.codec, row.data) for row in rows})
+        db.session.commit()
+    if total:
+        logger.info(f"已为 {total} 条巡检输出建立全文索引")
+
+def bump_device_version(session=None):
+    """递增设备表版本号并返回新版本
+
+    必须在写事务中调用：先执行UPDATE获得SQLite写锁，版本号因此与提交顺序一致，
+    增量同步不会漏掉较晚提交的较小版本。
+    """
+    session = session or db.session
+    counter_table = SyncCounter.__table__
+    session.execute(
+        counter_table.update()
+        .where(counter_table.c.name == 'device')
+        .values(value=counter_table.c.value + 1)
+    )
+    return session.execute(
+        db.select([counter_table.c.value]).where(counter_table.c.name == 'device')
+    ).scalar()
+
+def current_device_version():
+    return db.session.query(SyncCounter.value).filter_by(name='device').scalar() or 0
+
+@db.event.listens_for(db.session, 'before_flush')
+def assign_device_versions(session, flush_context, instances):
+    """通过ORM新增、修改、删除设备时自动分配版本号并记录删除"""
+    changed = [obj for obj in session.new if isinstance(obj, Device)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Device) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Device)]
+    if not changed and not deleted:
+        return
+    version = bump_device_version(session)
+    for device in changed:
+        device.version = version
+    for device in deleted:
+        session.add(DeviceTombstone(device_id=device.id, version=version))
+
+@db.event.listens_for(db.session, 'before_flush')
+def store_output_blobs(session, flush_context, instances):
+    """写入新巡检记录引用的输出，已存在的相同输出直接复用，新输出同时加入全文索引"""
+    blobs = {}
+    outputs = {}
+    for obj in session.new:
+        if isinstance(obj, InspectionRecordOutput) and getattr(obj, 'pending_blob', None):
+            blobs[obj.blob_hash] = obj.pending_blob
+            outputs[obj.blob_hash] = obj.pending_output
+    if blobs:
+        # 先写入输出获得写锁，再检查索引，并发写入时不会重复索引
+        session.execute(
+            sqlite_insert(OutputBlob.__table__).on_conflict_do_nothing(index_elements=['hash']),
+            list(blobs.values())
+        )
+        index_output_blobs(session, outputs)
+
+@db.event.listens_for(db.session, 'after_flush')
+def update_latest_metrics(session, flush_context):
+    """新巡检记录写入后更新设备指标的最新值，较早的记录不会覆盖较新的值"""
+    rows = [
+        {
+            'device_id': metric.device_id,
+            'metric': metric.metric,
+            'value': metric.value,
+            'record_id': record.id,
+            'updated_at': metric.created_at
+        }
+        for record in session.new if isinstance(record, InspectionRecord)
+        for metric in record.metrics
+    ]
+    if not rows:
+        return
+    statement = sqlite_insert(DeviceMetric.__table__)
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=['device_id', 'metric'],
+            set_={
+                'value': statement.excluded.value,
+                'record_id': statement.excluded.record_id,
+                'updated_at': statement.excluded.updated_at
+            },
+            where=statement.excluded.updated_at >= DeviceMetric.__table__.c.updated_at
+        ),
+        rows
+    )
+
 # 创建数据库表
 with app.app_context():
     try:
         db.create_all()
+        run_schema_migrations()
+        init_device_version()
+        init_output_search()
         logger.info("数据库表创建成功")
+        mark_startup_stage('初始化数据库')
     except Exception as e:
         logger.error(f"数据库表创建失败: {str(e)}")
         raise
@@ -122,64 +880,672 @@ def get_device_type(device_type, protocol):
         return f"{device_type}_telnet"
     return device_type
 
-def check_device_status(device):
-    """检查设备状态"""
+# 服务端事件推送 - 进程内广播设备状态变化和巡检进度，多个页面共享同一份事件
+class EventBroker:
+    """事件广播器，每个订阅者一个有界队列，消费过慢的订阅者会丢弃事件"""
+
+    def __init__(self, max_queue_size=1000):
+        self.max_queue_size = max_queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        # 只序列化一次，所有订阅者共享同一条消息
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                logger.warning(f"事件订阅者队列已满，丢弃事件 {event}")
+
+event_broker = EventBroker()
+
+# 后台写入队列 - 状态检查和批量巡检线程的数据库写入都由同一个线程执行，
+# 避免多个线程争抢SQLite写锁；API请求仍直接读写数据库
+class DatabaseWriter:
+    """单线程数据库写入器
+
+    写入任务是在db.session上执行但不提交的函数，可能被重复执行（合并提交失败时逐个重试），
+    因此不能有数据库以外的副作用。队列中同时等待的任务在一个事务中提交。
+    """
+
+    WriteTask = namedtuple('WriteTask', ['future', 'fn', 'args'])
+
+    def __init__(self, max_batch=100):
+        self.max_batch = max_batch
+        self.tasks = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """提交写入任务，返回Future，结果为任务函数的返回值"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self.thread.start()
+        future = Future()
+        self.tasks.put(self.WriteTask(future, fn, args))
+        return future
+
+    def write(self, fn, *args):
+        """提交写入任务并等待提交完成"""
+        return self.submit(fn, *args).result()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                batch = [self.tasks.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self.tasks.get_nowait())
+                    except queue.Empty:
+                        break
+                batch = [task for task in batch if task.future.set_running_or_notify_cancel()]
+                if batch:
+                    self._execute(batch)
+
+    def _execute(self, batch):
+        try:
+            results = [task.fn(*task.args) for task in batch]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            # 合并提交失败时逐个执行，只让出错的任务失败
+            logger.warning(f"合并写入 {len(batch)} 个任务失败，改为逐个写入: {str(e)}")
+            for task in batch:
+                self._execute([task])
+            return
+        for task, result in zip(batch, results):
+            task.future.set_result(result)
+
+db_writer = DatabaseWriter(max_batch=app.config['DB_WRITER_BATCH_SIZE'])
+
+# 设备状态检查 - 使用asyncio并发探测所有设备
+# 当前状态保存在内存中，只有状态切换时才写数据库，last_check按STATUS_FLUSH_INTERVAL批量刷新
+PROTOCOL_PORTS = {'ssh': 22, 'telnet': 23}
+
+# 设备ID -> 当前状态
+device_status_cache = {}
+# 设备ID -> 最近一次探测可达的时间，每轮检查都会变化，不写入设备表，通过/api/status/devices查询
+device_last_seen = {}
+# 最近一次批量刷新last_check的时间戳
+last_check_flushed_at = [0.0]
+
+# 最近一轮状态检查的统计信息
+last_status_sweep = {}
+
+async def probe_tcp(ip, port, timeout):
+    """TCP连接设备管理端口，能建立连接或被拒绝都说明主机可达"""
     try:
-        # 根据操作系统选择ping命令
-        if platform.system().lower() == 'windows':
-            ping_cmd = f'ping -n 1 -w 1000 {device.ip}'
-        else:
-            ping_cmd = f'ping -c 1 -W 1 {device.ip}'
-            
-        result = subprocess.run(ping_cmd, shell=True, capture_output=True, text=True)
-        device.status = 'online' if result.returncode == 0 else 'offline'
-        device.last_check = datetime.now(tz)
-        db.session.commit()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        writer.close()
+        return True
+    except ConnectionRefusedError:
+        return True
+    except Exception:
+        return False
+
+async def probe_ping(ip, timeout):
+    """调用系统ping命令探测设备"""
+    if platform.system().lower() == 'windows':
+        ping_args = ['ping', '-n', '1', '-w', str(int(timeout * 1000)), ip]
+    else:
+        ping_args = ['ping', '-c', '1', '-W', str(max(1, int(timeout))), ip]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ping_args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            return await asyncio.wait_for(process.wait(), timeout + 1) == 0
+        except asyncio.TimeoutError:
+            process.kill()
+            return False
     except Exception as e:
-        print(f"检查设备 {device.ip} 状态时出错: {str(e)}")
-        device.status = 'offline'
-        device.last_check = datetime.now(tz)
-        db.session.commit()
+        logger.error(f"检查设备 {ip} 状态时出错: {str(e)}")
+        return False
+
+async def probe_devices(targets, method, timeout, concurrency):
+    """并发探测设备，targets为 (设备ID, IP, 协议) 列表，返回 {设备ID: 是否可达}"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(device_id, ip, protocol):
+        async with semaphore:
+            if method == 'ping':
+                reachable = await probe_ping(ip, timeout)
+            else:
+                reachable = await probe_tcp(ip, PROTOCOL_PORTS.get((protocol or '').lower(), 22), timeout)
+        return device_id, reachable
+
+    results = await asyncio.gather(*(probe(*target) for target in targets))
+    return dict(results)
+
+def sweep_device_status():
+    """检查所有设备状态并持久化状态变化，返回本轮检查的统计信息"""
+    start_time = time.time()
+    method = app.config['STATUS_PROBE_METHOD']
+    targets = db.session.query(Device.id, Device.ip, Device.protocol, Device.status).all()
+    reachability = asyncio.run(probe_devices(
+        [(device_id, ip, protocol) for device_id, ip, protocol, _ in targets],
+        method,
+        app.config['STATUS_PROBE_TIMEOUT'],
+        app.config['STATUS_PROBE_CONCURRENCY']
+    ))
+
+    now = datetime.now(tz)
+    transitions = []
+    statuses = {}
+    for device_id, _, _, db_status in targets:
+        status = 'online' if reachability.get(device_id) else 'offline'
+        statuses[device_id] = status
+        # 首次检查时以数据库中的状态为准
+        if device_status_cache.get(device_id, db_status) != status:
+            transitions.append({'b_id': device_id, 'b_status': status, 'b_last_check': now})
+
+    flushed = bool(targets) and start_time - last_check_flushed_at[0] >= app.config['STATUS_FLUSH_INTERVAL']
+
+    def write_status_changes():
+        device_table = Device.__table__
+        version = None
+        if transitions:
+            version = bump_device_version()
+            db.session.execute(
+                device_table.update()
+                .where(device_table.c.id == bindparam('b_id'))
+                .values(status=bindparam('b_status'), last_check=bindparam('b_last_check'), version=version),
+                transitions
+            )
+            db.session.execute(
+                DeviceStatusHistory.__table__.insert(),
+                [{'device_id': row['b_id'], 'status': row['b_status'], 'changed_at': now} for row in transitions]
+            )
+        if flushed:
+            # 只刷新检查时间，不递增版本号，否则每次刷新都会让所有设备出现在增量同步结果中
+            db.session.execute(device_table.update().values(last_check=now))
+        return version
+
+    if transitions or flushed:
+        version = db_writer.write(write_status_changes)
+        if flushed:
+            last_check_flushed_at[0] = start_time
+
+    # 写入成功后才更新缓存，写入失败时下一轮检查仍会发现这些状态变化并重新写入
+    device_status_cache.update(statuses)
+    for device_id, status in statuses.items():
+        if status == 'online':
+            device_last_seen[device_id] = now
+    # 清理已删除设备的缓存
+    for device_id in list(device_status_cache):
+        if device_id not in statuses:
+            device_status_cache.pop(device_id, None)
+            device_last_seen.pop(device_id, None)
+
+    if transitions:
+        event_broker.publish('device_status', {
+            'version': version,
+            'changes': [{
+                'device_id': row['b_id'],
+                'status': row['b_status'],
+                'changed_at': now.isoformat()
+            } for row in transitions]
+        })
+    if flushed:
+        event_broker.publish('status_flush', {'last_check': now.isoformat()})
+
+    online = sum(1 for reachable in reachability.values() if reachable)
+    return {
+        'method': method,
+        'started_at': now.isoformat(),
+        'duration': round(time.time() - start_time, 3),
+        'device_count': len(targets),
+        'online': online,
+        'offline': len(targets) - online,
+        'changed': len(transitions),
+        'last_check_flushed': flushed
+    }
 
 def check_all_devices():
-    """检查所有设备状态"""
+    """定期检查所有设备状态"""
     while True:
+        interval = app.config['STATUS_CHECK_INTERVAL']
+        duration = 0
         with app.app_context():
-            devices = Device.query.all()
-            for device in devices:
-                check_device_status(device)
-        time.sleep(30)  # 每30秒检查一次
+            try:
+                stats = sweep_device_status()
+                last_status_sweep.clear()
+                last_status_sweep.update(stats)
+                duration = stats['duration']
+                logger.info(
+                    f"设备状态检查完成，共 {stats['device_count']} 台，在线 {stats['online']} 台，"
+                    f"状态变化 {stats['changed']} 台，耗时 {duration:.2f} 秒"
+                )
+                if duration > interval:
+                    logger.warning(f"设备状态检查耗时 {duration:.2f} 秒，超过检查间隔 {interval} 秒")
+            except Exception as e:
+                logger.error(f"设备状态检查失败: {str(e)}")
+                db.session.rollback()
+        time.sleep(max(1, interval - duration))
+
+def is_serving_process():
+    """python app.py以debug模式启动时，Werkzeug重载器的监视进程也会导入本模块，
+    该进程不处理请求，不应启动后台线程，否则状态检查等任务会运行两份"""
+    return __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
 
 # 启动状态检查线程
 status_check_thread = threading.Thread(target=check_all_devices, daemon=True)
-status_check_thread.start()
+if is_serving_process():
+    status_check_thread.start()
+
+# 巡检历史清理 - 按保留策略分批删除过期的巡检记录和日志，每批一个事务，删除后增量回收空间
+# 最近一次清理的统计信息
+last_compaction = {}
+# 调用/api/compaction立即执行清理
+compaction_requested = threading.Event()
+
+def retention_cutoffs(now):
+    """返回(全部保留的起点, 每天保留的起点, 删除的起点)，不精简时前两项为None，不删除时最后一项为None"""
+    keep_all = daily = expire = None
+    if app.config['RETENTION_KEEP_ALL_DAYS']:
+        keep_all = now - timedelta(days=app.config['RETENTION_KEEP_ALL_DAYS'])
+        daily = min(keep_all, now - timedelta(days=app.config['RETENTION_DAILY_DAYS']))
+    if app.config['RETENTION_WEEKLY_DAYS']:
+        expire = now - timedelta(days=app.config['RETENTION_WEEKLY_DAYS'])
+        if daily is not None:
+            expire = min(daily, expire)
+    return keep_all, daily, expire
+
+def select_thinned_records(device_id, start, end, bucket):
+    """时间范围内一台设备每个时间段只保留最后一条记录（优先保留成功的记录），返回其余记录的ID
+
+    按设备查询可以利用(device_id, created_at)索引，一轮清理中每条记录只参与一次排序。
+    """
+    ranked = db.session.query(
+        InspectionRecord.id.label('id'),
+        db.func.row_number().over(
+            partition_by=bucket,
+            order_by=(
+                db.case([(InspectionRecord.status == '失败', 1)], else_=0),
+                InspectionRecord.created_at.desc(),
+                InspectionRecord.id.desc()
+            )
+        ).label('rank')
+    ).filter(InspectionRecord.device_id == device_id, InspectionRecord.created_at < end)
+    if start is not None:
+        ranked = ranked.filter(InspectionRecord.created_at >= start)
+    ranked = ranked.subquery()
+    return [record_id for (record_id,) in db.session.query(ranked.c.id).filter(ranked.c.rank > 1).all()]
+
+def delete_inspection_records(record_ids):
+    """批量删除巡检记录及其输出、差异和指标，并清理不再被引用的输出和全文索引
+
+    作为写入任务执行，只修改数据库。设备最新指标保留，即使对应的记录已被删除。
+    """
+    blob_hashes = [hash for (hash,) in db.session.query(InspectionRecordOutput.blob_hash)
+                   .filter(InspectionRecordOutput.record_id.in_(record_ids)).distinct().all()]
+    for model in (InspectionRecordOutput, InspectionRecordDiff, InspectionMetric):
+        model.query.filter(model.record_id.in_(record_ids)).delete(synchronize_session=False)
+    deleted = InspectionRecord.query.filter(InspectionRecord.id.in_(record_ids)).delete(synchronize_session=False)
+    OutputBlob.delete_unreferenced(blob_hashes)
+    return deleted
+
+def delete_inspection_logs(log_ids):
+    InspectionLogDevice.query.filter(InspectionLogDevice.log_id.in_(log_ids)).delete(synchronize_session=False)
+    return InspectionLog.query.filter(InspectionLog.id.in_(log_ids)).delete(synchronize_session=False)
+
+def incremental_vacuum(pages):
+    """写入任务：回收最多pages个空闲页，数据库未开启增量回收时不做任何操作
+
+    sqlite3模块执行不返回行的语句时只执行一步，每次只回收一页，因此逐页执行；
+    在写入任务的事务中执行，由db_writer统一提交。
+    """
+    if db.session.execute(db.text('PRAGMA auto_vacuum')).scalar() != 2:
+        return 0
+    free_pages = db.session.execute(db.text('PRAGMA freelist_count')).scalar()
+    pages = min(pages, free_pages)
+    for _ in range(pages):
+        db.session.execute(db.text('PRAGMA incremental_vacuum(1)'))
+    return pages
+
+def compact_inspection_history():
+    """按保留策略清理一轮，每批删除COMPACTION_BATCH_SIZE条，批与批之间其他写入可以插入
+
+    每台设备的待删除记录只查询一次，攒够一批后删除，查询总量与记录数成正比。
+    """
+    start_time = time.time()
+    now = datetime.now(tz).replace(tzinfo=None)
+    batch_size = app.config['COMPACTION_BATCH_SIZE']
+    vacuum_pages = app.config['COMPACTION_VACUUM_PAGES']
+    keep_all, daily, expire = retention_cutoffs(now)
+    stats = {'daily': 0, 'weekly': 0, 'expired': 0, 'logs': 0, 'reclaimed_pages': 0}
+
+    def delete_batch(delete, ids):
+        deleted = db_writer.write(delete, ids)
+        if vacuum_pages:
+            stats['reclaimed_pages'] += db_writer.write(incremental_vacuum, vacuum_pages)
+        return deleted
+
+    if keep_all is not None:
+        # 每天一个时间段；每周从周一开始
+        tiers = [
+            ('daily', daily, keep_all, db.func.date(InspectionRecord.created_at)),
+            ('weekly', expire, daily, db.func.date(InspectionRecord.created_at, 'weekday 0', '-6 days')),
+        ]
+        device_ids = [device_id for (device_id,) in db.session.query(InspectionRecord.device_id)
+                      .filter(InspectionRecord.created_at < keep_all).distinct().all()]
+        pending = []
+        for device_id in device_ids:
+            for name, start, end, bucket in tiers:
+                record_ids = select_thinned_records(device_id, start, end, bucket)
+                stats[name] += len(record_ids)
+                pending.extend(record_ids)
+            db.session.rollback()
+            while len(pending) >= batch_size:
+                delete_batch(delete_inspection_records, pending[:batch_size])
+                pending = pending[batch_size:]
+        if pending:
+            delete_batch(delete_inspection_records, pending)
+
+    if expire is not None:
+        # 已删除的记录不会再被查到，每批查询只扫描索引的开头
+        while True:
+            record_ids = [record_id for (record_id,) in db.session.query(InspectionRecord.id)
+                          .filter(InspectionRecord.created_at < expire).limit(batch_size).all()]
+            db.session.rollback()
+            if not record_ids:
+                break
+            stats['expired'] += delete_batch(delete_inspection_records, record_ids)
+
+    if app.config['RETENTION_LOG_DAYS']:
+        log_cutoff = now - timedelta(days=app.config['RETENTION_LOG_DAYS'])
+        while True:
+            log_ids = [log_id for (log_id,) in db.session.query(InspectionLog.id)
+                       .filter(InspectionLog.start_time < log_cutoff, InspectionLog.status != '进行中')
+                       .limit(batch_size).all()]
+            db.session.rollback()
+            if not log_ids:
+                break
+            stats['logs'] += delete_batch(delete_inspection_logs, log_ids)
+
+    stats['started_at'] = now.isoformat()
+    stats['duration'] = round(time.time() - start_time, 3)
+    return stats
+
+def enable_incremental_vacuum():
+    """把已有的数据库转换为增量回收空间模式，需要执行一次完整的VACUUM
+
+    VACUUM会重写整个数据库文件，执行期间数据库被锁定，并需要与数据库大小相当的空闲磁盘空间。
+    """
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        connection.exec_driver_sql('VACUUM')
+        return connection.exec_driver_sql('PRAGMA auto_vacuum').scalar()
+
+def run_compaction():
+    """定期清理巡检历史"""
+    while True:
+        compaction_requested.wait(app.config['COMPACTION_INTERVAL'] or None)
+        compaction_requested.clear()
+        with app.app_context():
+            try:
+                stats = compact_inspection_history()
+                last_compaction.clear()
+                last_compaction.update(stats)
+                if stats['daily'] or stats['weekly'] or stats['expired'] or stats['logs']:
+                    logger.info(
+                        f"巡检历史清理完成，删除记录 {stats['daily'] + stats['weekly'] + stats['expired']} 条，"
+                        f"删除日志 {stats['logs']} 条，回收 {stats['reclaimed_pages']} 页，耗时 {stats['duration']:.2f} 秒"
+                    )
+            except Exception as e:
+                logger.error(f"巡检历史清理失败: {str(e)}")
+                db.session.rollback()
+
+# 启动巡检历史清理线程
+compaction_thread = threading.Thread(target=run_compaction, daemon=True)
+if is_serving_process():
+    compaction_thread.start()
+
+@app.route('/api/compaction', methods=['GET'])
+def get_compaction():
+    """返回保留策略和最近一次清理的统计信息"""
+    return jsonify({
+        'interval': app.config['COMPACTION_INTERVAL'],
+        'keep_all_days': app.config['RETENTION_KEEP_ALL_DAYS'],
+        'daily_days': app.config['RETENTION_DAILY_DAYS'],
+        'weekly_days': app.config['RETENTION_WEEKLY_DAYS'],
+        'log_days': app.config['RETENTION_LOG_DAYS'],
+        'incremental_vacuum': db.session.execute(db.text('PRAGMA auto_vacuum')).scalar() == 2,
+        'last_compaction': last_compaction or None
+    })
+
+@app.route('/api/compaction', methods=['POST'])
+def start_compaction():
+    """立即执行一轮清理"""
+    compaction_requested.set()
+    return jsonify({'success': True, 'message': '已开始清理巡检历史'})
+
+@app.route('/api/compaction/auto-vacuum', methods=['POST'])
+def convert_auto_vacuum():
+    """把升级前创建的数据库转换为增量回收空间模式，转换前清理只删除数据，不缩小数据库文件
+
+    执行期间整个数据库被锁定，数据库较大时需要几分钟，请在没有巡检任务时执行。
+    """
+    try:
+        if db.session.execute(db.text('PRAGMA auto_vacuum')).scalar() == 2:
+            return jsonify({'success': True, 'message': '数据库已开启增量回收空间'})
+        db.session.commit()
+        start_time = time.time()
+        if enable_incremental_vacuum() != 2:
+            return jsonify({'success': False, 'message': '数据库转换失败'}), 500
+        logger.info(f"数据库已转换为增量回收空间模式，耗时 {time.time() - start_time:.2f} 秒")
+        return jsonify({'success': True, 'message': '数据库已开启增量回收空间'})
+    except Exception as e:
+        logger.error(f"转换数据库回收空间模式失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# 设备列表分页查询参数
+DEVICE_LIST_PARAMS = ('limit', 'offset', 'cursor', 'fields', 'group', 'status', 'device_type', 'ip_prefix')
+
+def parse_device_fields(args):
+    """解析fields参数，未指定时使用分页列表的默认字段"""
+    fields = Device.LIST_FIELDS
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in Device.FIELDS]
+        if unknown:
+            raise ValueError(f"不支持的字段: {', '.join(unknown)}")
+        if 'id' not in fields:
+            fields = ['id'] + fields
+    return fields
+
+def query_device_changes(args, version):
+    """返回指定版本之后新增、修改和删除的设备"""
+    since = args.get('since', type=int)
+    if since is None:
+        raise ValueError('since参数必须是整数')
+    fields = parse_device_fields(args)
+    columns = [getattr(Device, field) for field in fields]
+    devices = Device.query.options(load_only(*columns))\
+        .filter(Device.version > since, Device.version <= version)\
+        .order_by(Device.id).all()
+    deleted_ids = [device_id for device_id, in db.session.query(DeviceTombstone.device_id)
+                   .filter(DeviceTombstone.version > since, DeviceTombstone.version <= version)]
+    # 设备删除后又以相同ID重新创建时只报告为变更
+    changed_ids = set(device.id for device in devices)
+    return {
+        'version': version,
+        'since': since,
+        'changed': [device.to_dict(fields) for device in devices],
+        'deleted': sorted(set(device_id for device_id in deleted_ids if device_id not in changed_ids))
+    }
+
+def query_device_page(args):
+    """按请求参数过滤、分页设备列表，并只加载需要的字段"""
+    fields = parse_device_fields(args)
+
+    query = Device.query
+    for name in ('group', 'status', 'device_type'):
+        if args.get(name):
+            query = query.filter(getattr(Device, name) == args[name])
+    if args.get('ip_prefix'):
+        # 使用范围条件代替LIKE，以便利用ip列的索引
+        prefix = args['ip_prefix']
+        query = query.filter(Device.ip >= prefix, Device.ip < prefix + '\uffff')
+    total = query.count()
+
+    limit = min(max(args.get('limit', 100, type=int), 1), 1000)
+    query = query.order_by(Device.id)
+    # 空的cursor参数视为未指定
+    if args.get('cursor'):
+        cursor = args.get('cursor', type=int)
+        if cursor is None:
+            raise ValueError(f"cursor参数必须是整数: {args['cursor']}")
+        query = query.filter(Device.id > cursor)
+        offset = None
+    else:
+        offset = max(args.get('offset', 0, type=int), 0)
+        query = query.offset(offset)
+
+    columns = [getattr(Device, field) for field in fields]
+    devices = query.options(load_only(*columns)).limit(limit + 1).all()
+    has_more = len(devices) > limit
+    devices = devices[:limit]
+    return {
+        'items': [device.to_dict(fields) for device in devices],
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'next_cursor': devices[-1].id if has_more else None
+    }
 
 # API路由
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
     try:
-        devices = Device.query.all()
-        logger.info(f"成功获取设备列表，共{len(devices)}个设备")
-        return jsonify([device.to_dict() for device in devices])
+        # 设备表未变化时直接返回304，ETag由设备表版本号和查询参数组成
+        version = current_device_version()
+        etag = hashlib.md5(f"{version}?{request.query_string.decode('utf-8')}".encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        elif 'since' in request.args:
+            response = jsonify(query_device_changes(request.args, version))
+        elif any(name in request.args for name in DEVICE_LIST_PARAMS):
+            # 带分页/过滤/字段参数时返回分页结果，否则保持原有的完整列表格式
+            response = jsonify(query_device_page(request.args))
+        else:
+            devices = Device.query.all()
+            logger.info(f"成功获取设备列表，共{len(devices)}个设备")
+            response = jsonify([device.to_dict() for device in devices])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        # 完整列表没有版本号字段，客户端从响应头获得版本号作为增量同步的起点
+        response.headers['X-Device-Version'] = str(version)
+        return response
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"获取设备列表失败: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """SSE事件流：device_status、status_flush、inspection_progress、inspection_finished"""
+    def generate():
+        subscriber = event_broker.subscribe()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield subscriber.get(timeout=15)
+                except queue.Empty:
+                    # 定期发送注释行保持连接，并及时发现已断开的客户端
+                    yield ': keepalive\n\n'
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/status/sweep', methods=['GET'])
+def get_status_sweep():
+    """返回最近一轮设备状态检查的统计信息"""
+    return jsonify({
+        'interval': app.config['STATUS_CHECK_INTERVAL'],
+        'last_sweep': last_status_sweep or None
+    })
+
+@app.route('/api/status/devices', methods=['GET'])
+def get_status_devices():
+    """内存中各设备的当前状态和最近一次探测可达的时间，不查询数据库，也不影响设备表版本号"""
+    # 状态检查线程会同时修改缓存，遍历副本
+    result = []
+    for device_id, status in list(device_status_cache.items()):
+        last_seen = device_last_seen.get(device_id)
+        result.append({
+            'device_id': device_id,
+            'status': status,
+            'last_seen': last_seen.isoformat() if last_seen else None
+        })
+    return jsonify(result)
+
+@app.route('/api/devices/<int:device_id>/status-history', methods=['GET'])
+def get_device_status_history(device_id):
+    try:
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        history = DeviceStatusHistory.query.filter_by(device_id=device_id)\
+            .order_by(DeviceStatusHistory.changed_at.desc()).limit(limit).all()
+        return jsonify([item.to_dict() for item in history])
+    except Exception as e:
+        logger.error(f"获取设备 {device_id} 状态历史失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/status-history/flapping', methods=['GET'])
+def get_flapping_devices():
+    """统计指定时间段内状态切换次数较多的设备"""
+    try:
+        hours = request.args.get('hours', 24, type=int)
+        min_changes = request.args.get('min_changes', 4, type=int)
+        since = datetime.now(tz) - timedelta(hours=hours)
+        change_count = db.func.count(DeviceStatusHistory.id)
+        rows = db.session.query(DeviceStatusHistory.device_id, change_count, db.func.max(DeviceStatusHistory.changed_at))\
+            .filter(DeviceStatusHistory.changed_at >= since)\
+            .group_by(DeviceStatusHistory.device_id)\
+            .having(change_count >= min_changes)\
+            .order_by(change_count.desc()).all()
+        return jsonify([{
+            'device_id': device_id,
+            'changes': changes,
+            'last_changed_at': last_changed_at.isoformat()
+        } for device_id, changes, last_changed_at in rows])
+    except Exception as e:
+        logger.error(f"统计设备状态抖动失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/devices', methods=['POST'])
 def add_device():
     try:
         data = request.json
         
         # 处理commands字段，确保存储格式正确
-        commands = data.get('commands', '')
-        # 如果commands是JSON字符串，尝试解析并转换为逗号分隔的字符串
-        try:
-            if isinstance(commands, str) and commands.startswith('[') and commands.endswith(']'):
-                commands_list = json.loads(commands)
-                commands = ','.join([str(cmd).strip() for cmd in commands_list if cmd])
-        except:
-            # 如果解析失败，保持原样
-            pass
+        commands = normalize_commands_field(data.get('commands', ''))
         
         device = Device(
             name=data['name'],
@@ -190,10 +1556,13 @@ def add_device():
             device_type=data['device_type'],
             protocol=data['protocol'],
             commands=commands,
+            profile_id=get_profile_id(data.get('profile_id')),
             group=data.get('group', '交换机')  # 新增分组字段，默认为"交换机"
         )
         db.session.add(device)
         db.session.commit()
+        # SQLite会复用已删除设备的ID，清除可能残留的缓存
+        command_plans.invalidate(device.id)
         logger.info(f"成功添加设备: {device.name}")
         return jsonify(device.to_dict())
     except Exception as e:
@@ -206,6 +1575,8 @@ def delete_device(device_id):
     device = Device.query.get_or_404(device_id)
     db.session.delete(device)
     db.session.commit()
+    connection_pool.discard(device_id)
+    command_plans.invalidate(device_id)
     return '', 204
 
 @app.route('/api/devices/<int:device_id>', methods=['PUT'])
@@ -215,15 +1586,7 @@ def update_device(device_id):
         data = request.json
         
         # 处理commands字段，确保存储格式正确
-        commands = data.get('commands', '')
-        # 如果commands是JSON字符串，尝试解析并转换为逗号分隔的字符串
-        try:
-            if isinstance(commands, str) and commands.startswith('[') and commands.endswith(']'):
-                commands_list = json.loads(commands)
-                commands = ','.join([str(cmd).strip() for cmd in commands_list if cmd])
-        except:
-            # 如果解析失败，保持原样
-            pass
+        commands = normalize_commands_field(data.get('commands', ''))
         
         # 更新设备信息
         device.name = data['name']
@@ -234,9 +1597,13 @@ def update_device(device_id):
         device.device_type = data['device_type']
         device.protocol = data['protocol']
         device.commands = commands
+        if 'profile_id' in data:
+            device.profile_id = get_profile_id(data['profile_id'])
         device.group = data.get('group', '交换机')  # 新增分组字段，默认为"交换机"
         
         db.session.commit()
+        connection_pool.discard(device_id)
+        command_plans.invalidate(device_id)
         logger.info(f"成功更新设备: {device.name}")
         return jsonify(device.to_dict())
     except Exception as e:
@@ -244,8 +1611,209 @@ def update_device(device_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def get_profile_id(profile_id):
+    """校验设备引用的命令模板是否存在"""
+    if profile_id in (None, ''):
+        return None
+    profile = CommandProfile.query.get(int(profile_id))
+    if not profile:
+        raise ValueError(f'命令模板 {profile_id} 不存在')
+    return profile.id
+
+@app.route('/api/devices/<int:device_id>/commands', methods=['GET'])
+def get_device_commands(device_id):
+    """返回设备实际使用的巡检命令及来源"""
+    try:
+        device = Device.query.get_or_404(device_id)
+        device_info = device_snapshot(device)
+        return jsonify({
+            'device_id': device.id,
+            'profile_id': device_info['profile_id'],
+            'commands': list(command_plans.compile(device_info['commands']).commands)
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"获取设备 {device_id} 巡检命令失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# 命令模板API
+@app.route('/api/command-profiles', methods=['GET'])
+def get_command_profiles():
+    try:
+        profiles = CommandProfile.query.order_by(CommandProfile.id).all()
+        device_counts = dict(db.session.query(Device.profile_id, db.func.count(Device.id))
+                             .filter(Device.profile_id.isnot(None)).group_by(Device.profile_id).all())
+        result = []
+        for profile in profiles:
+            item = profile.to_dict()
+            item['device_count'] = device_counts.get(profile.id, 0)
+            result.append(item)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"获取命令模板失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def apply_profile_data(profile, data):
+    """校验并写入命令模板字段"""
+    if not data.get('name'):
+        raise ValueError('请填写模板名称')
+    commands = normalize_commands_field(data.get('commands', ''))
+    # 提前编译一次，拒绝没有有效命令的模板
+    command_plans.compile(commands)
+    profile.name = data['name']
+    profile.commands = commands
+    profile.device_type = data.get('device_type') or None
+    profile.group = data.get('group') or None
+
+@app.route('/api/command-profiles', methods=['POST'])
+def add_command_profile():
+    try:
+        profile = CommandProfile()
+        apply_profile_data(profile, request.json or {})
+        db.session.add(profile)
+        db.session.commit()
+        logger.info(f"成功添加命令模板: {profile.name}")
+        return jsonify(profile.to_dict())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"添加命令模板失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/command-profiles/<int:profile_id>', methods=['PUT'])
+def update_command_profile(profile_id):
+    try:
+        profile = CommandProfile.query.get_or_404(profile_id)
+        apply_profile_data(profile, request.json or {})
+        db.session.commit()
+        logger.info(f"成功更新命令模板: {profile.name}")
+        return jsonify(profile.to_dict())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"更新命令模板失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/command-profiles/<int:profile_id>', methods=['DELETE'])
+def delete_command_profile(profile_id):
+    try:
+        profile = CommandProfile.query.get_or_404(profile_id)
+        device_count = Device.query.filter_by(profile_id=profile_id).count()
+        if device_count:
+            return jsonify({'error': f'命令模板正被 {device_count} 台设备使用，无法删除'}), 400
+        db.session.delete(profile)
+        db.session.commit()
+        return jsonify({'success': True, 'message': '命令模板删除成功'})
+    except Exception as e:
+        logger.error(f"删除命令模板失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/health-rules', methods=['GET'])
+def get_health_rules():
+    try:
+        rules = HealthRule.query.order_by(HealthRule.id).all()
+        return jsonify([rule.to_dict() for rule in rules])
+    except Exception as e:
+        logger.error(f"获取健康规则失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def apply_health_rule_data(rule, data):
+    """校验并写入健康规则字段"""
+    if not data.get('name'):
+        raise ValueError('请填写规则名称')
+    if data.get('rule_type') not in ('threshold', 'pattern'):
+        raise ValueError('规则类型必须是threshold或pattern')
+    severity = data.get('severity') or '警告'
+    if severity not in HEALTH_SEVERITIES:
+        raise ValueError(f"告警级别必须是{'、'.join(HEALTH_SEVERITIES)}之一")
+    rule.name = data['name']
+    rule.rule_type = data['rule_type']
+    rule.severity = severity
+    rule.group = data.get('group') or None
+    rule.device_type = data.get('device_type') or None
+    rule.enabled = bool(data.get('enabled', True))
+    if rule.rule_type == 'threshold':
+        if not data.get('metric'):
+            raise ValueError('阈值规则需要指定指标名')
+        if data.get('operator') not in HEALTH_RULE_OPERATORS:
+            raise ValueError(f"比较运算符必须是{' '.join(HEALTH_RULE_OPERATORS)}之一")
+        try:
+            threshold = float(data.get('threshold'))
+        except (TypeError, ValueError):
+            raise ValueError('阈值必须是数字')
+        rule.metric, rule.operator, rule.threshold = data['metric'], data['operator'], threshold
+        rule.command_pattern = rule.pattern = None
+        rule.match = 'present'
+    else:
+        if not data.get('pattern'):
+            raise ValueError('匹配规则需要指定输出正则')
+        if data.get('match', 'present') not in ('present', 'absent'):
+            raise ValueError('match必须是present或absent')
+        rule.command_pattern = data.get('command_pattern') or None
+        rule.pattern = data['pattern']
+        rule.match = data.get('match', 'present')
+        rule.metric = rule.operator = rule.threshold = None
+    # 提前编译一次，拒绝无效的正则
+    compile_health_rule(rule)
+
+@app.route('/api/health-rules', methods=['POST'])
+def add_health_rule():
+    try:
+        rule = HealthRule()
+        apply_health_rule_data(rule, request.json or {})
+        db.session.add(rule)
+        db.session.commit()
+        health_rules.invalidate()
+        logger.info(f"成功添加健康规则: {rule.name}")
+        return jsonify(rule.to_dict())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"添加健康规则失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/health-rules/<int:rule_id>', methods=['PUT'])
+def update_health_rule(rule_id):
+    try:
+        rule = HealthRule.query.get_or_404(rule_id)
+        apply_health_rule_data(rule, request.json or {})
+        db.session.commit()
+        health_rules.invalidate()
+        logger.info(f"成功更新健康规则: {rule.name}")
+        return jsonify(rule.to_dict())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"更新健康规则失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/health-rules/<int:rule_id>', methods=['DELETE'])
+def delete_health_rule(rule_id):
+    try:
+        rule = HealthRule.query.get_or_404(rule_id)
+        db.session.delete(rule)
+        db.session.commit()
+        health_rules.invalidate()
+        return jsonify({'success': True, 'message': '健康规则删除成功'})
+    except Exception as e:
+        logger.error(f"删除健康规则失败: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/devices/<int:device_id>/inspect', methods=['POST'])
 def inspect_device(device_id):
+    import netmiko
+
     device = Device.query.get_or_404(device_id)
     
     # 检查设备状态
@@ -260,14 +1828,14 @@ def inspect_device(device_id):
         inspection_log = InspectionLog(
             total_devices=1,
             status='进行中',
-            details=json.dumps([{
-                'device_id': device.id,
-                'device_name': device.name,
-                'device_ip': device.ip,
-                'status': '进行中',
-                'message': '正在巡检...',
-                'start_time': datetime.now(tz).isoformat()
-            }])
+            devices=[InspectionLogDevice(
+                device_id=device.id,
+                device_name=device.name,
+                device_ip=device.ip,
+                status='进行中',
+                message='正在巡检...',
+                start_time=datetime.now(tz)
+            )]
         )
         db.session.add(inspection_log)
         db.session.commit()
@@ -275,136 +1843,15 @@ def inspect_device(device_id):
         # 记录开始时间
         start_time = time.time()
         
-        # 获取设备类型
-        device_type = get_device_type(device.device_type, device.protocol)
-        
-        logger.info(f"开始巡检设备: {device.name} ({device.ip}), 设备类型: {device_type}")
-        
-        # 连接设备
-        connection_params = {
-            'device_type': device_type,
-            'host': device.ip,
-            'username': device.username,
-            'password': device.password,
-            'timeout': 20,
-            'auth_timeout': 20,
-            'banner_timeout': 20,
-            'fast_cli': False
-        }
-        
-        # 如果配置了enable密码，添加到连接参数中
-        if device.enable_password and device.enable_password.strip():
-            connection_params['secret'] = device.enable_password
-        
-        # 建立连接
-        logger.info(f"正在连接设备: {device.ip}")
-        connection = netmiko.ConnectHandler(**connection_params)
-        logger.info(f"成功连接到设备: {device.ip}")
-        
-        # 如果是Cisco IOS设备并且有enable密码，进入enable模式
-        if 'cisco_ios' in device_type and device.enable_password and device.enable_password.strip():
-            logger.info(f"正在进入enable模式: {device.ip}")
-            connection.enable()
-            logger.info(f"已进入enable模式: {device.ip}")
-        elif 'ruijie_os' in device_type:
-            logger.info(f"锐捷交换机设备 {device.ip} 不需要进入 enable 模式，跳过此步骤")
-        
-        # 解析并执行巡检命令
-        results = []
-        try:
-            # 尝试解析命令
-            try:
-                if device.commands.startswith('[') and device.commands.endswith(']'):
-                    # 如果命令是JSON数组格式
-                    commands_list = json.loads(device.commands)
-                    # 确保每个命令都是纯文本字符串
-                    commands = [str(cmd).strip() for cmd in commands_list if cmd]
-                else:
-                    # 如果不是JSON格式，尝试按逗号分隔
-                    commands = [cmd.strip() for cmd in device.commands.split(',') if cmd.strip()]
-            except json.JSONDecodeError:
-                # 如果JSON解析失败，尝试按逗号分隔处理
-                commands = [cmd.strip() for cmd in device.commands.split(',') if cmd.strip()]
-            except Exception as e:
-                logger.error(f"命令解析错误: {str(e)}")
-                # 如果所有尝试都失败，将整个commands作为单个命令
-                commands = [device.commands] if device.commands else []
-            
-            # 确保commands是列表类型且每个命令都是纯文本字符串
-            if not isinstance(commands, list):
-                commands = [str(commands)] if commands else []
-            else:
-                commands = [str(cmd) for cmd in commands]
-            
-            # 清理命令，移除所有可能的特殊字符和格式
-            cleaned_commands = []
-            for cmd in commands:
-                # 移除所有可能的引号（单引号和双引号）
-                cmd = cmd.replace('"', '').replace("'", '')
-                # 移除所有可能的方括号
-                cmd = cmd.replace('[', '').replace(']', '')
-                # 移除命令前后的空白字符
-                cmd = cmd.strip()
-                # 如果命令不为空，添加到清理后的命令列表
-                if cmd:
-                    cleaned_commands.append(cmd)
-            
-            commands = cleaned_commands
-            logger.info(f"清理后的设备 {device.ip} 的巡检命令: {commands}")
-            
-            # 执行命令
-            command_success = True  # 添加命令执行状态跟踪
-            command_results = []  # 添加command_results变量定义
-            for cmd in commands:
-                try:
-                    logger.info(f"设备 {device.ip} 执行命令: {cmd}")
-                    output = connection.send_command(cmd, strip_prompt=False, strip_command=False)
-                    command_results.append({
-                        'command': cmd,
-                        'output': output
-                    })
-                    logger.info(f"设备 {device.ip} 命令 {cmd} 执行成功")
-                except Exception as e:
-                    error_msg = f"执行命令 {cmd} 失败: {str(e)}"
-                    logger.error(error_msg)
-                    command_success = False
-                    command_results.append({
-                        'command': cmd,
-                        'output': error_msg
-                    })
-        except Exception as e:
-            error_msg = f"处理巡检命令时出错: {str(e)}"
-            logger.error(error_msg)
-            # 更新巡检日志
-            inspection_log.end_time = datetime.now(tz)
-            inspection_log.failed_devices = 1
-            inspection_log.status = '已完成'
-            inspection_log.total_duration = time.time() - start_time
-            
-            device_details = json.loads(inspection_log.details)
-            device_details[0]['status'] = '失败'
-            device_details[0]['message'] = error_msg
-            device_details[0]['end_time'] = datetime.now(tz).isoformat()
-            inspection_log.details = json.dumps(device_details)
-            
-            db.session.commit()
-            
-            return jsonify({
-                'success': False,
-                'message': error_msg
-            }), 400
-        
-        # 断开连接
-        connection.disconnect()
-        logger.info(f"已断开与设备 {device.ip} 的连接")
+        # 从连接池获取会话并执行巡检命令
+        device_info = device_snapshot(device)
+        command_success, command_results = run_device_commands(device_info, timeout=20)
         
         # 保存巡检记录
         try:
-            record = InspectionRecord(
-                device_id=device.id,
-                device_name=device.name,
-                result=json.dumps(command_results, ensure_ascii=False)
-            )
+            record = InspectionRecord(device_id=device.id, device_name=device.name)
+            record.set_results(command_results, command_success)
+            diff_with_previous_record(record, command_results)
             db.session.add(record)
             db.session.commit()
             logger.info(f"设备 {device.name} ({device.ip}) 巡检完成，已保存记录")
@@ -427,11 +1874,13 @@ def inspect_device(device_id):
         inspection_log.status = '已完成' if command_success else '已完成但失败'
         inspection_log.total_duration = time.time() - start_time
         
-        device_details = json.loads(inspection_log.details)
-        device_details[0]['status'] = '成功' if command_success else '失败'
-        device_details[0]['message'] = '巡检完成' if command_success else error_msg
-        device_details[0]['end_time'] = datetime.now(tz).isoformat()
-        inspection_log.details = json.dumps(device_details)
+        inspection_log.devices[0].mark(
+            '成功' if command_success else '失败',
+            '巡检完成' if command_success else '部分命令执行失败'
+        )
+        verdict, findings = health_rules.evaluate(device_info, command_results)
+        inspection_log.devices[0].verdict = verdict
+        inspection_log.devices[0].findings = json.dumps(findings, ensure_ascii=False)
         
         db.session.commit()
         
@@ -450,11 +1899,7 @@ def inspect_device(device_id):
         inspection_log.status = '已完成'
         inspection_log.total_duration = time.time() - start_time
         
-        device_details = json.loads(inspection_log.details)
-        device_details[0]['status'] = '失败'
-        device_details[0]['message'] = error_msg
-        device_details[0]['end_time'] = datetime.now(tz).isoformat()
-        inspection_log.details = json.dumps(device_details)
+        inspection_log.devices[0].mark('失败', error_msg)
         
         db.session.commit()
         
@@ -472,11 +1917,7 @@ def inspect_device(device_id):
         inspection_log.status = '已完成'
         inspection_log.total_duration = time.time() - start_time
         
-        device_details = json.loads(inspection_log.details)
-        device_details[0]['status'] = '失败'
-        device_details[0]['message'] = error_msg
-        device_details[0]['end_time'] = datetime.now(tz).isoformat()
-        inspection_log.details = json.dumps(device_details)
+        inspection_log.devices[0].mark('失败', error_msg)
         
         db.session.commit()
         
@@ -494,11 +1935,7 @@ def inspect_device(device_id):
         inspection_log.status = '已完成'
         inspection_log.total_duration = time.time() - start_time
         
-        device_details = json.loads(inspection_log.details)
-        device_details[0]['status'] = '失败'
-        device_details[0]['message'] = error_msg
-        device_details[0]['end_time'] = datetime.now(tz).isoformat()
-        inspection_log.details = json.dumps(device_details)
+        inspection_log.devices[0].mark('失败', error_msg)
         
         db.session.commit()
         
@@ -513,13 +1950,288 @@ def get_device_records(device_id):
         # 检查设备是否存在
         device = Device.query.get_or_404(device_id)
         # 获取该设备的所有巡检记录，按时间倒序排序
-        records = InspectionRecord.query.filter_by(device_id=device_id).order_by(InspectionRecord.created_at.desc()).all()
+        records = InspectionRecord.query.options(selectinload(InspectionRecord.outputs))\
+            .filter_by(device_id=device_id).order_by(InspectionRecord.created_at.desc()).all()
         logger.info(f"成功获取设备 {device.name} 的巡检记录，共 {len(records)} 条")
         return jsonify([record.to_dict() for record in records])
     except Exception as e:
         logger.error(f"获取设备 {device_id} 的巡检记录失败: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+RECORD_LIST_COLUMNS = (
+    InspectionRecord.id,
+    InspectionRecord.device_id,
+    InspectionRecord.device_name,
+    InspectionRecord.result_size,
+    InspectionRecord.status,
+    InspectionRecord.created_at
+)
+
+@app.route('/api/records', methods=['GET'])
+def get_records():
+    """全部设备的巡检记录索引，分页返回元数据，不读取巡检输出"""
+    try:
+        query = InspectionRecord.query.options(load_only(*RECORD_LIST_COLUMNS))
+        device_ids = request.args.getlist('device_id', type=int)
+        if device_ids:
+            query = query.filter(InspectionRecord.device_id.in_(device_ids))
+        if request.args.get('status'):
+            query = query.filter(InspectionRecord.status == request.args['status'])
+        start = parse_time_arg(request.args, 'start')
+        if start:
+            query = query.filter(InspectionRecord.created_at >= start)
+        end = parse_time_arg(request.args, 'end')
+        if end:
+            query = query.filter(InspectionRecord.created_at < end)
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 200)
+        total = query.count()
+        records = query.order_by(InspectionRecord.created_at.desc(), InspectionRecord.id.desc())\
+            .offset((page - 1) * per_page).limit(per_page).all()
+        return jsonify({
+            'items': [record.to_summary_dict() for record in records],
+            'total': total,
+            'page': page,
+            'per_page': per_page
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"获取巡检记录列表失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/records/<int:record_id>', methods=['GET'])
+def get_record(record_id):
+    try:
+        record = InspectionRecord.query.get_or_404(record_id)
+        return jsonify(record.to_dict())
+    except Exception as e:
+        logger.error(f"获取巡检记录 {record_id} 失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/records/<int:record_id>/diff', methods=['GET'])
+def get_record_diff(record_id):
+    """巡检记录与同一设备上一条记录的逐命令差异，只返回有变化的命令"""
+    try:
+        record = InspectionRecord.query.options(load_only(*RECORD_LIST_COLUMNS, InspectionRecord.previous_record_id))\
+            .filter_by(id=record_id).first_or_404()
+        previous_created_at = None
+        if record.previous_record_id:
+            previous_created_at = db.session.query(InspectionRecord.created_at)\
+                .filter_by(id=record.previous_record_id).scalar()
+        data = record.to_summary_dict()
+        data.update({
+            'previous_record_id': record.previous_record_id,
+            'previous_created_at': previous_created_at.isoformat() if previous_created_at else None,
+            'diffs': [diff.to_dict() for diff in record.diffs]
+        })
+        return jsonify(data)
+    except Exception as e:
+        logger.error(f"获取巡检记录 {record_id} 的差异失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/records/changes', methods=['GET'])
+def get_changed_devices():
+    """时间范围内巡检输出有变化的设备，只查询记录表中保存的变化命令数，不读取输出
+
+    默认统计最近24小时，可通过start/end指定范围，group按设备分组过滤。
+    """
+    try:
+        start = parse_time_arg(request.args, 'start') or datetime.now(tz).replace(tzinfo=None) - timedelta(days=1)
+        end = parse_time_arg(request.args, 'end')
+        query = db.session.query(
+            InspectionRecord.device_id,
+            db.func.count(InspectionRecord.id).label('changed_records'),
+            db.func.sum(InspectionRecord.changed_commands).label('changed_commands'),
+            db.func.max(InspectionRecord.id).label('last_record_id'),
+            db.func.max(InspectionRecord.created_at).label('last_changed_at')
+        ).filter(InspectionRecord.created_at >= start, InspectionRecord.changed_commands > 0)
+        if end:
+            query = query.filter(InspectionRecord.created_at < end)
+        if request.args.get('group'):
+            query = query.join(Device, Device.id == InspectionRecord.device_id)\
+                .filter(Device.group == request.args['group'])
+        rows = query.group_by(InspectionRecord.device_id).all()
+
+        devices = dict(
+            (device_id, (name, ip)) for device_id, name, ip in
+            db.session.query(Device.id, Device.name, Device.ip).filter(Device.id.in_([row.device_id for row in rows])).all()
+        )
+        result = []
+        for row in sorted(rows, key=lambda item: item.last_changed_at, reverse=True):
+            name, ip = devices.get(row.device_id, (None, None))
+            result.append({
+                'device_id': row.device_id,
+                'device_name': name,
+                'device_ip': ip,
+                'changed_records': row.changed_records,
+                'changed_commands': row.changed_commands,
+                'last_record_id': row.last_record_id,
+                'last_changed_at': row.last_changed_at.isoformat()
+            })
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"获取有变化的设备失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+FTS_OPERATORS = {'AND', 'OR', 'NOT', 'NEAR'}
+
+def search_match_lines(output, terms, limit):
+    """返回输出中包含全部搜索词的行（不区分大小写），用于在结果中展示匹配位置"""
+    lines = []
+    for line in output.splitlines():
+        lowered = line.lower()
+        if all(term in lowered for term in terms):
+            lines.append(line.strip())
+            if len(lines) >= limit:
+                break
+    return lines
+
+@app.route('/api/records/search', methods=['GET'])
+def search_records():
+    """在巡检输出中全文搜索，如 q=%LINK-3-UPDOWN&start=2024-01-01 返回输出中出现该内容的命令
+
+    q按短语匹配；需要FTS5查询语法（AND/OR/NOT、前缀*）时使用fts参数。
+    可按device_id（可多个）、group、command（包含匹配）和start/end过滤，按巡检时间倒序分页返回。
+    """
+    try:
+        if not app.config['OUTPUT_SEARCH']:
+            return jsonify({'error': '全文搜索未启用'}), 400
+        if request.args.get('fts'):
+            match = request.args['fts']
+        elif request.args.get('q'):
+            match = '"' + request.args['q'].replace('"', '""') + '"'
+        else:
+            raise ValueError('缺少搜索内容q或fts参数')
+        terms = [term.lower() for term in re.findall(r'\w+', match) if term not in FTS_OPERATORS]
+        if not terms:
+            raise ValueError('搜索内容不能只包含符号')
+        try:
+            db.session.execute(db.text('SELECT 1 FROM output_fts WHERE output_fts MATCH :match LIMIT 1'), {'match': match})
+        except Exception as e:
+            raise ValueError(f'搜索语法错误: {str(getattr(e, "orig", e))}')
+
+        matched_entries = db.select([db.column('rowid')]).select_from(db.table('output_fts'))\
+            .where(db.text('output_fts MATCH :match'))
+        query = db.session.query(
+            InspectionRecordOutput.record_id,
+            InspectionRecordOutput.position,
+            InspectionRecordOutput.command,
+            InspectionRecordOutput.blob_hash,
+            InspectionRecord.device_id,
+            InspectionRecord.device_name,
+            InspectionRecord.created_at
+        ).join(InspectionRecord, InspectionRecord.id == InspectionRecordOutput.record_id)\
+            .join(OutputSearchEntry, OutputSearchEntry.blob_hash == InspectionRecordOutput.blob_hash)\
+            .filter(OutputSearchEntry.id.in_(matched_entries))\
+            .params(match=match)
+        device_ids = request.args.getlist('device_id', type=int)
+        if device_ids:
+            query = query.filter(InspectionRecord.device_id.in_(device_ids))
+        if request.args.get('group'):
+            query = query.join(Device, Device.id == InspectionRecord.device_id)\
+                .filter(Device.group == request.args['group'])
+        if request.args.get('command'):
+            query = query.filter(InspectionRecordOutput.command.contains(request.args['command'], autoescape=True))
+        start = parse_time_arg(request.args, 'start')
+        if start:
+            query = query.filter(InspectionRecord.created_at >= start)
+        end = parse_time_arg(request.args, 'end')
+        if end:
+            query = query.filter(InspectionRecord.created_at < end)
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 200)
+        total = query.count()
+        rows = query.order_by(
+            InspectionRecord.created_at.desc(), InspectionRecord.id.desc(), InspectionRecordOutput.position
+        ).offset((page - 1) * per_page).limit(per_page).all()
+
+        # 只解压当前页的输出来提取匹配行
+        outputs = OutputBlob.load_many([row.blob_hash for row in rows])
+        limit = app.config['SEARCH_MATCH_LINES']
+        return jsonify({
+            'items': [{
+                'record_id': row.record_id,
+                'device_id': row.device_id,
+                'device_name': row.device_name,
+                'created_at': row.created_at.isoformat(),
+                'command': row.command,
+                'lines': search_match_lines(outputs.get(row.blob_hash, ''), terms, limit)
+            } for row in rows],
+            'total': total,
+            'page': page,
+            'per_page': per_page
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"搜索巡检输出失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """按指标查询各设备的最新值，如 metric=cpu_usage&min=80 返回CPU使用率不低于80%的设备"""
+    try:
+        metric = request.args.get('metric')
+        if not metric:
+            names = db.session.query(DeviceMetric.metric, db.func.count(DeviceMetric.device_id))\
+                .group_by(DeviceMetric.metric).all()
+            return jsonify([{'metric': name, 'device_count': count} for name, count in names])
+
+        query = db.session.query(DeviceMetric, Device.name, Device.ip, Device.group)\
+            .join(Device, Device.id == DeviceMetric.device_id)\
+            .filter(DeviceMetric.metric == metric)
+        min_value = parse_number_arg(request.args, 'min')
+        if min_value is not None:
+            query = query.filter(DeviceMetric.value >= min_value)
+        max_value = parse_number_arg(request.args, 'max')
+        if max_value is not None:
+            query = query.filter(DeviceMetric.value <= max_value)
+        if request.args.get('group'):
+            query = query.filter(Device.group == request.args['group'])
+        rows = query.order_by(DeviceMetric.value.desc()).all()
+        return jsonify([{
+            'device_id': device_metric.device_id,
+            'device_name': name,
+            'device_ip': ip,
+            'group': group,
+            'metric': device_metric.metric,
+            'value': device_metric.value,
+            'record_id': device_metric.record_id,
+            'updated_at': device_metric.updated_at.isoformat()
+        } for device_metric, name, ip, group in rows])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"查询设备指标失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/devices/<int:device_id>/metrics', methods=['GET'])
+def get_device_metrics(device_id):
+    """设备指标历史，可按metric和start/end过滤"""
+    try:
+        query = InspectionMetric.query.filter(InspectionMetric.device_id == device_id)
+        if request.args.get('metric'):
+            query = query.filter(InspectionMetric.metric == request.args['metric'])
+        start = parse_time_arg(request.args, 'start')
+        if start:
+            query = query.filter(InspectionMetric.created_at >= start)
+        end = parse_time_arg(request.args, 'end')
+        if end:
+            query = query.filter(InspectionMetric.created_at < end)
+        limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+        metrics = query.order_by(InspectionMetric.created_at.desc()).limit(limit).all()
+        return jsonify([metric.to_dict() for metric in metrics])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"获取设备 {device_id} 的指标历史失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/records/<int:record_id>', methods=['DELETE'])
 def delete_record(record_id):
     try:
@@ -528,8 +2240,11 @@ def delete_record(record_id):
         # 记录相关信息
         device_name = record.device_name
         device_id = record.device_id
-        # 删除记录
+        blob_hashes = [output.blob_hash for output in record.outputs]
+        # 删除记录，并清理不再被引用的输出
         db.session.delete(record)
+        db.session.flush()
+        OutputBlob.delete_unreferenced(blob_hashes)
         db.session.commit()
         logger.info(f"成功删除设备 {device_name} (ID: {device_id}) 的巡检记录 (ID: {record_id})")
         return jsonify({'success': True, 'message': '巡检记录删除成功'})
@@ -543,29 +2258,69 @@ def serve_frontend():
     return send_from_directory('frontend', 'index.html')
 
 # 添加导入导出API
+EXPORT_DEVICE_COLUMNS = ['设备名称', 'IP地址', '用户名', '密码', 'Enable密码', '设备类型', '连接协议', '巡检命令', '命令模板', '设备分组']
+
+def iter_export_device_rows():
+    """按批次从数据库游标读取设备，逐行返回导出的单元格内容"""
+    profile_names = dict(db.session.query(CommandProfile.id, CommandProfile.name).all())
+    query = db.session.query(
+        Device.name, Device.ip, Device.username, Device.password, Device.enable_password,
+        Device.device_type, Device.protocol, Device.commands, Device.profile_id, Device.group
+    ).order_by(Device.id).yield_per(app.config['EXPORT_CHUNK_SIZE'] * 20)
+    for device in query:
+        yield [
+            device.name,
+            device.ip,
+            device.username,
+            device.password,
+            device.enable_password or '',
+            device.device_type,
+            device.protocol,
+            device.commands,
+            profile_names.get(device.profile_id, ''),
+            device.group
+        ]
+
 @app.route('/api/devices/export', methods=['GET'])
 def export_devices():
+    """导出设备列表，format=csv时流式生成CSV，默认生成xlsx"""
+    export_format = request.args.get('format', 'xlsx')
+    if export_format not in ('xlsx', 'csv'):
+        return jsonify({'error': f'不支持的导出格式: {export_format}'}), 400
+
+    if export_format == 'csv':
+        def generate():
+            output = io.StringIO()
+            writer = csv.writer(output)
+            # 带BOM，Excel打开时可以正确识别中文
+            output.write('\ufeff')
+            writer.writerow(EXPORT_DEVICE_COLUMNS)
+            for index, row in enumerate(iter_export_device_rows(), start=1):
+                writer.writerow(row)
+                if index % 500 == 0:
+                    yield output.getvalue().encode('utf-8')
+                    output.seek(0)
+                    output.truncate()
+            yield output.getvalue().encode('utf-8')
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote('设备列表.csv')}"}
+        )
+
     try:
-        devices = Device.query.all()
-        data = []
-        for device in devices:
-            data.append({
-                '设备名称': device.name,
-                'IP地址': device.ip,
-                '用户名': device.username,
-                '密码': device.password,
-                'Enable密码': device.enable_password or '',
-                '设备类型': device.device_type,
-                '连接协议': device.protocol,
-                '巡检命令': device.commands,
-                '设备分组': device.group
-            })
-        
-        df = pd.DataFrame(data)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='设备列表')
-        
+        import openpyxl
+
+        # 只写模式逐行写入工作表，xlsx写入临时文件后再发送
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('设备列表')
+        worksheet.append(EXPORT_DEVICE_COLUMNS)
+        for row in iter_export_device_rows():
+            worksheet.append(row)
+
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
         output.seek(0)
         return send_file(
             output,
@@ -574,11 +2329,113 @@ def export_devices():
             download_name='设备列表.xlsx'
         )
     except Exception as e:
-        logger.error(f"导出设备列表失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        logger.error(f"导出设备列表失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+IMPORT_REQUIRED_COLUMNS = ['设备名称', 'IP地址', '用户名', '密码', '设备类型', '连接协议', '巡检命令']
+
+def import_cell_text(value):
+    """单元格内容转换为字符串，空单元格返回None"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value).strip()
+    return value or None
+
+def iter_import_rows(file):
+    """逐行读取导入文件，返回 (表头, 行迭代器)，行迭代器产生 (行号, {列名: 值})
+
+    行迭代器读完或调用close()时关闭文件，只读模式的工作簿必须显式关闭，否则会一直占用上传的文件。
+    """
+    workbook = None
+    if file.filename.endswith('.csv'):
+        rows = csv.reader(io.TextIOWrapper(file.stream, encoding='utf-8-sig'))
+    else:
+        import openpyxl
+
+        # 只读模式按行读取，不把整个工作簿加载到内存
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+
+    def generate():
+        try:
+            # 先产生表头，迭代器因此已经开始执行，未读完就close()时也会执行finally
+            header = [import_cell_text(name) for name in next(rows, ())]
+            yield header
+            for row_number, values in enumerate(rows, start=2):
+                row = {name: import_cell_text(value) for name, value in zip(header, values) if name}
+                if any(row.values()):
+                    yield row_number, row
+        finally:
+            if workbook is not None:
+                workbook.close()
+
+    rows_iter = generate()
+    return next(rows_iter), rows_iter
+
+def import_device_chunk(chunk, profiles_by_name, row_errors):
+    """导入一批设备：一次查询已存在的IP，批量新增和更新后提交，返回 (新增数, 更新数, 更新的设备ID)"""
+    mappings = {}  # IP -> (行号, 设备字段)，文件中重复的IP以最后一行为准
+    for row_number, row in chunk:
+        try:
+            missing = [name for name in IMPORT_REQUIRED_COLUMNS if name != '巡检命令' and not row.get(name)]
+            if missing:
+                raise ValueError(f"{'、'.join(missing)}不能为空")
+            # 可选的命令模板列，按模板名称关联
+            profile_id = None
+            if row.get('命令模板'):
+                profile_id = profiles_by_name.get(row['命令模板'])
+                if profile_id is None:
+                    raise ValueError(f"命令模板 {row['命令模板']} 不存在")
+            mappings[row['IP地址']] = (row_number, {
+                'name': row['设备名称'],
+                'ip': row['IP地址'],
+                'username': row['用户名'],
+                'password': row['密码'],
+                'enable_password': row.get('Enable密码'),
+                'device_type': row['设备类型'],
+                'protocol': row['连接协议'],
+                'commands': normalize_commands_field(row.get('巡检命令') or ''),
+                'profile_id': profile_id,
+                'group': row.get('设备分组') or '交换机'
+            })
+        except Exception as e:
+            row_errors.append({'row': row_number, 'ip': row.get('IP地址'), 'error': str(e)})
+
+    if not mappings:
+        return 0, 0, []
+
+    try:
+        # 按IP索引一次查出本批次中已存在的设备
+        existing_ids = dict(
+            db.session.query(Device.ip, Device.id).filter(Device.ip.in_(list(mappings.keys()))).all()
+        )
+        # 批量操作不触发before_flush，需要手动分配设备表版本号
+        version = bump_device_version()
+        new_devices = []
+        updated_devices = []
+        for ip, (_, values) in mappings.items():
+            values['version'] = version
+            if ip in existing_ids:
+                values['id'] = existing_ids[ip]
+                updated_devices.append(values)
+            else:
+                new_devices.append(values)
+        db.session.bulk_insert_mappings(Device, new_devices)
+        db.session.bulk_update_mappings(Device, updated_devices)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"导入设备批次失败: {str(e)}")
+        for ip, (row_number, _) in mappings.items():
+            row_errors.append({'row': row_number, 'ip': ip, 'error': f'批次写入失败: {str(e)}'})
+        return 0, 0, []
+    return len(new_devices), len(updated_devices), [values['id'] for values in updated_devices]
 
 @app.route('/api/devices/import', methods=['POST'])
 def import_devices():
+    """批量导入设备，支持.xlsx和.csv；按批次读取和提交，返回逐行的错误报告"""
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': '未找到上传文件'}), 400
     
@@ -586,70 +2443,62 @@ def import_devices():
     if file.filename == '':
         return jsonify({'success': False, 'error': '未选择文件'}), 400
     
-    if not file.filename.endswith('.xlsx'):
-        return jsonify({'success': False, 'error': '只能上传.xlsx格式的文件'}), 400
+    if not file.filename.endswith(('.xlsx', '.csv')):
+        return jsonify({'success': False, 'error': '只能上传.xlsx或.csv格式的文件'}), 400
     
+    rows = None
     try:
-        # 读取Excel文件
-        df = pd.read_excel(file)
+        header, rows = iter_import_rows(file)
         
         # 检查必要的列是否存在
-        required_columns = ['设备名称', 'IP地址', '用户名', '密码', '设备类型', '连接协议', '巡检命令']
-        for col in required_columns:
-            if col not in df.columns:
-                return jsonify({'success': False, 'error': f'Excel文件缺少"{col}"列'}), 400
-        
-        success_count = 0
-        error_count = 0
-        errors = []
-        
-        # 遍历行并导入设备
-        for index, row in df.iterrows():
-            try:
-                # 检查设备是否已存在（按IP地址检查）
-                existing_device = Device.query.filter_by(ip=row['IP地址']).first()
-                if existing_device:
-                    # 更新现有设备
-                    existing_device.name = row['设备名称']
-                    existing_device.username = row['用户名']
-                    existing_device.password = row['密码']
-                    existing_device.enable_password = row['Enable密码'] if 'Enable密码' in row and not pd.isna(row['Enable密码']) else None
-                    existing_device.device_type = row['设备类型']
-                    existing_device.protocol = row['连接协议']
-                    existing_device.commands = row['巡检命令']
-                    existing_device.group = row['设备分组'] if '设备分组' in row and not pd.isna(row['设备分组']) else '交换机'
-                else:
-                    # 创建新设备
-                    new_device = Device(
-                        name=row['设备名称'],
-                        ip=row['IP地址'],
-                        username=row['用户名'],
-                        password=row['密码'],
-                        enable_password=row['Enable密码'] if 'Enable密码' in row and not pd.isna(row['Enable密码']) else None,
-                        device_type=row['设备类型'],
-                        protocol=row['连接协议'],
-                        commands=row['巡检命令'],
-                        group=row['设备分组'] if '设备分组' in row and not pd.isna(row['设备分组']) else '交换机'
-                    )
-                    db.session.add(new_device)
-                
-                success_count += 1
-            except Exception as e:
-                error_count += 1
-                errors.append(f"行 {index+2}: {str(e)}")
-        
-        db.session.commit()
-        logger.info(f"设备导入完成，成功: {success_count}，失败: {error_count}")
+        for col in IMPORT_REQUIRED_COLUMNS:
+            if col not in header:
+                return jsonify({'success': False, 'error': f'导入文件缺少"{col}"列'}), 400
+        
+        created_count = 0
+        updated_count = 0
+        row_errors = []
+        chunk_size = app.config['IMPORT_CHUNK_SIZE']
+        profiles_by_name = dict(db.session.query(CommandProfile.name, CommandProfile.id).all())
+        
+        chunk = []
+        for row_number, row in rows:
+            chunk.append((row_number, row))
+            if len(chunk) >= chunk_size:
+                created, updated, updated_ids = import_device_chunk(chunk, profiles_by_name, row_errors)
+                created_count += created
+                updated_count += updated
+                for device_id in updated_ids:
+                    connection_pool.discard(device_id)
+                chunk = []
+        if chunk:
+            created, updated, updated_ids = import_device_chunk(chunk, profiles_by_name, row_errors)
+            created_count += created
+            updated_count += updated
+            for device_id in updated_ids:
+                connection_pool.discard(device_id)
+        
+        command_plans.invalidate()
+        success_count = created_count + updated_count
+        row_errors.sort(key=lambda item: item['row'])
+        logger.info(f"设备导入完成，新增: {created_count}，更新: {updated_count}，失败: {len(row_errors)}")
         
         return jsonify({
             'success': True,
             'message': f'导入完成，成功导入 {success_count} 个设备',
-            'error_count': error_count,
-            'errors': errors
+            'created_count': created_count,
+            'updated_count': updated_count,
+            'error_count': len(row_errors),
+            'errors': [f"行 {item['row']}: {item['error']}" for item in row_errors],
+            'row_errors': row_errors
         })
     except Exception as e:
+        db.session.rollback()
         logger.error(f"导入设备数据失败: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if rows is not None:
+            rows.close()
 
 @app.route('/api/records/<int:record_id>/export', methods=['GET'])
 def export_record(record_id):
@@ -662,23 +2511,13 @@ def export_record(record_id):
         
         # 解析巡检结果
         try:
-            results = json.loads(record.result)
+            results = record.get_results()
         except Exception as e:
             logger.error(f"解析巡检结果失败: {str(e)}")
             return jsonify({'error': f"解析巡检结果失败: {str(e)}"}), 500
         
         # 将巡检结果格式化为文本
-        content = []
-        content.append(f"设备名称: {record.device_name}")
-        content.append(f"设备IP: {device.ip if device else '未知'}")
-        content.append(f"巡检时间: {record.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
-        content.append("="*50)
-        
-        for item in results:
-            content.append(f"\n[命令] {item['command']}")
-            content.append("-"*50)
-            content.append(f"{item['output']}")
-            content.append("-"*50)
+        content = format_record_text(record, device.ip if device else None, results)
         
         # 创建文件名
         device_ip = device.ip if device else "unknown"
@@ -687,7 +2526,7 @@ def export_record(record_id):
         
         # 创建内存文件
         output = io.StringIO()
-        output.write("\n".join(content))
+        output.write(content)
         output.seek(0)
         
         # 发送文件
@@ -701,77 +2540,972 @@ def export_record(record_id):
         logger.error(f"导出巡检记录失败: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+class ZipStreamBuffer(io.RawIOBase):
+    """ZipFile的只写输出缓冲，每写完一段由响应生成器取走已写入的数据"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def format_record_text(record, device_ip, results):
+    """将巡检结果格式化为导出的文本"""
+    content = []
+    content.append(f"设备名称: {record.device_name}")
+    content.append(f"设备IP: {device_ip or '未知'}")
+    content.append(f"巡检时间: {record.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
+    content.append("="*50)
+
+    for item in results:
+        content.append(f"\n[命令] {item['command']}")
+        content.append("-"*50)
+        content.append(f"{item['output']}")
+        content.append("-"*50)
+    return "\n".join(content)
+
+def iter_export_records(record_ids, chunk_size):
+    """按批次加载巡检记录，每批一次查询记录、设备IP和输出，返回 (记录, 设备IP, 巡检结果)"""
+    for offset in range(0, len(record_ids), chunk_size):
+        chunk_ids = record_ids[offset:offset + chunk_size]
+        records = InspectionRecord.query.options(selectinload(InspectionRecord.outputs))\
+            .filter(InspectionRecord.id.in_(chunk_ids)).all()
+        records_by_id = {record.id: record for record in records}
+        device_ips = dict(
+            db.session.query(Device.id, Device.ip)
+            .filter(Device.id.in_(set(record.device_id for record in records)))
+            .all()
+        )
+        blobs = OutputBlob.load_many([output.blob_hash for record in records for output in record.outputs])
+
+        for record_id in chunk_ids:
+            record = records_by_id.get(record_id)
+            if not record:
+                logger.warning(f"巡检记录 {record_id} 不存在")
+                continue
+            try:
+                results = record.get_results(blobs)
+            except Exception:
+                logger.warning(f"解析巡检记录 {record_id} 结果失败")
+                continue
+            yield record, device_ips.get(record.device_id), results
+
+        # 释放本批次的记录和输出，内存占用不随导出数量增长
+        db.session.expunge_all()
+
 @app.route('/api/records/batch-export', methods=['GET'])
 def batch_export_records():
-    try:
-        # 获取要导出的记录ID列表
-        record_ids = request.args.getlist('id', type=int)
-        
-        if not record_ids:
-            return jsonify({'error': '未指定要导出的记录ID'}), 400
-        
-        # 创建ZIP文件
-        memory_file = io.BytesIO()
-        
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for record_id in record_ids:
-                try:
-                    # 获取巡检记录
-                    record = InspectionRecord.query.get(record_id)
-                    if not record:
-                        logger.warning(f"巡检记录 {record_id} 不存在")
-                        continue
-                    
-                    # 获取设备信息
-                    device = Device.query.get(record.device_id)
-                    
-                    # 解析巡检结果
+    """流式导出ZIP，每写完一个文件就发送给客户端"""
+    # 获取要导出的记录ID列表
+    record_ids = request.args.getlist('id', type=int)
+
+    if not record_ids:
+        return jsonify({'error': '未指定要导出的记录ID'}), 400
+
+    def generate():
+        buffer = ZipStreamBuffer()
+        try:
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for record, device_ip, results in iter_export_records(record_ids, app.config['EXPORT_CHUNK_SIZE']):
                     try:
-                        results = json.loads(record.result)
-                    except:
-                        logger.warning(f"解析巡检记录 {record_id} 结果失败")
+                        # 创建文件名
+                        timestamp = record.created_at.strftime("%Y%m%d_%H%M%S")
+                        filename = f"{record.device_name}_{device_ip or 'unknown'}_{timestamp}.txt"
+
+                        # 添加到ZIP文件
+                        zf.writestr(filename, format_record_text(record, device_ip, results))
+                    except Exception as e:
+                        logger.error(f"处理记录 {record.id} 时出错: {str(e)}")
                         continue
-                    
-                    # 将巡检结果格式化为文本
-                    content = []
-                    content.append(f"设备名称: {record.device_name}")
-                    content.append(f"设备IP: {device.ip if device else '未知'}")
-                    content.append(f"巡检时间: {record.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
-                    content.append("="*50)
-                    
-                    for item in results:
-                        content.append(f"\n[命令] {item['command']}")
-                        content.append("-"*50)
-                        content.append(f"{item['output']}")
-                        content.append("-"*50)
-                    
-                    # 创建文件名
-                    device_ip = device.ip if device else "unknown"
-                    timestamp = record.created_at.strftime("%Y%m%d_%H%M%S")
-                    filename = f"{record.device_name}_{device_ip}_{timestamp}.txt"
-                    
-                    # 添加到ZIP文件
-                    zf.writestr(filename, "\n".join(content))
-                    
-                except Exception as e:
-                    logger.error(f"处理记录 {record_id} 时出错: {str(e)}")
+                    yield buffer.drain()
+            yield buffer.drain()
+        except Exception as e:
+            # 响应已开始发送，只能中断下载
+            logger.error(f"批量导出巡检记录失败: {str(e)}")
+            raise
+
+    timestamp = datetime.now(tz).strftime("%Y%m%d_%H%M%S")
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=inspection_records_{timestamp}.zip'}
+    )
+
+# SSH/Telnet连接池 - 按设备ID保留空闲会话，重复巡检时跳过登录过程
+class ConnectionPool:
+    """设备会话连接池
+
+    每台设备最多保留一个空闲会话，超过空闲时间(idle_ttl)或连接参数变化时断开；
+    打开的会话总数（空闲+使用中）不超过max_open，达到上限时优先断开最久未使用的空闲会话。
+    """
+
+    def __init__(self, max_open, idle_ttl):
+        self.max_open = max_open
+        self.idle_ttl = idle_ttl
+        self.idle = OrderedDict()  # 设备ID -> (会话, 连接参数指纹, 最后使用时间)，按最近使用排序
+        self.open_count = 0
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def fingerprint(connection_params):
+        keys = ('device_type', 'host', 'port', 'username', 'password', 'secret')
+        return hashlib.sha256(json.dumps([connection_params.get(key) for key in keys]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.disconnect()
+        except Exception as e:
+            logger.warning(f"断开会话时出错: {str(e)}")
+
+    def acquire(self, device_id, connection_params, setup=None, wait_timeout=60):
+        """获取设备会话，优先复用健康的空闲会话，否则新建连接"""
+        fingerprint = self.fingerprint(connection_params)
+        with self.condition:
+            entry = self.idle.pop(device_id, None)
+
+        if entry:
+            connection, entry_fingerprint, last_used = entry
+            if entry_fingerprint == fingerprint and time.time() - last_used < self.idle_ttl and self.is_healthy(connection):
+                logger.info(f"复用设备 {connection_params['host']} 的空闲会话")
+                return connection
+            self.close(connection)
+            self._forget()
+
+        # 新建连接前先占用一个名额，达到上限时断开最久未使用的空闲会话或等待
+        deadline = time.time() + wait_timeout
+        while True:
+            evicted = None
+            with self.condition:
+                if self.open_count < self.max_open:
+                    self.open_count += 1
+                    break
+                if self.idle:
+                    _, (evicted, _, _) = self.idle.popitem(last=False)
+                    self.open_count -= 1
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception(f'连接池已满（{self.max_open}个会话），等待空闲会话超时')
+                    self.condition.wait(remaining)
+            if evicted is not None:
+                self.close(evicted)
+
+        connection = None
+        try:
+            import netmiko
+
+            logger.info(f"尝试连接设备: {connection_params['host']}")
+            connection = netmiko.ConnectHandler(**connection_params)
+            logger.info(f"成功连接到设备: {connection_params['host']}")
+            if setup:
+                setup(connection)
+        except Exception:
+            if connection is not None:
+                self.close(connection)
+            self._forget()
+            raise
+        connection._pool_fingerprint = fingerprint
+        return connection
+
+    def release(self, device_id, connection, reusable=True):
+        """归还会话，不可复用或连接池已禁用时直接断开"""
+        if not reusable or self.idle_ttl <= 0:
+            self.close(connection)
+            self._forget()
+            return
+        with self.condition:
+            replaced = self.idle.pop(device_id, None)
+            self.idle[device_id] = (connection, connection._pool_fingerprint, time.time())
+        # 同一设备同时有多个会话时只保留最新归还的一个
+        if replaced:
+            self.close(replaced[0])
+            self._forget()
+
+    def discard(self, device_id):
+        """设备被修改或删除时断开其空闲会话"""
+        with self.condition:
+            entry = self.idle.pop(device_id, None)
+        if entry:
+            self.close(entry[0])
+            self._forget()
+
+    def reap(self):
+        """断开超过空闲时间的会话"""
+        expired = []
+        with self.condition:
+            now = time.time()
+            for device_id, (connection, _, last_used) in list(self.idle.items()):
+                if now - last_used >= self.idle_ttl:
+                    expired.append(connection)
+                    del self.idle[device_id]
+        for connection in expired:
+            self.close(connection)
+            self._forget()
+        return len(expired)
+
+    @staticmethod
+    def is_healthy(connection):
+        try:
+            return connection.is_alive()
+        except Exception:
+            return False
+
+    def _forget(self):
+        with self.condition:
+            self.open_count -= 1
+            self.condition.notify()
+
+connection_pool = ConnectionPool(
+    max_open=app.config['CONNECTION_POOL_MAX_OPEN'],
+    idle_ttl=app.config['CONNECTION_POOL_IDLE_TTL']
+)
+
+def reap_idle_connections():
+    """定期清理过期的空闲会话"""
+    while True:
+        time.sleep(30)
+        try:
+            closed = connection_pool.reap()
+            if closed:
+                logger.info(f"已断开 {closed} 个过期的空闲会话")
+        except Exception as e:
+            logger.error(f"清理空闲会话失败: {str(e)}")
+
+connection_pool_reaper = threading.Thread(target=reap_idle_connections, daemon=True)
+connection_pool_reaper.start()
+
+# 批量巡检引擎 - 线程池并发巡检，全局和分组两级并发限制
+class CommandProfileResolver:
+    """解析设备实际使用的巡检命令
+
+    优先级：设备指定的模板 > 设备自定义命令 > 分组+设备类型默认模板 > 分组默认模板 > 设备类型默认模板。
+    批量巡检时一次加载全部模板，避免逐台设备查询。
+    """
+
+    def __init__(self, profiles=None):
+        if profiles is None:
+            profiles = CommandProfile.query.order_by(CommandProfile.id).all()
+        self.profiles = {}
+        self.defaults = {}
+        for profile in profiles:
+            self.profiles[profile.id] = profile
+            if profile.device_type or profile.group:
+                # 同一范围有多个默认模板时使用最早创建的
+                self.defaults.setdefault((profile.group or None, profile.device_type or None), profile)
+
+    def resolve(self, device):
+        """返回 (命令原文, 模板ID)，使用设备自定义命令时模板ID为None"""
+        profile = self.profiles.get(device.profile_id) if device.profile_id else None
+        if profile is None and device.commands and device.commands.strip():
+            return device.commands, None
+        if profile is None:
+            group = device.group or '交换机'
+            for scope in ((group, device.device_type), (group, None), (None, device.device_type)):
+                profile = self.defaults.get(scope)
+                if profile:
+                    break
+        if profile is None:
+            return device.commands or '', None
+        return profile.commands, profile.id
+
+def device_snapshot(device, resolver=None):
+    """提取巡检所需的设备字段，供巡检线程在独立会话中使用"""
+    if resolver is None:
+        resolver = CommandProfileResolver()
+    commands, profile_id = resolver.resolve(device)
+    return {
+        'id': device.id,
+        'name': device.name,
+        'ip': device.ip,
+        'username': device.username,
+        'password': device.password,
+        'enable_password': device.enable_password,
+        'device_type': device.device_type,
+        'protocol': device.protocol,
+        'commands': commands,
+        'profile_id': profile_id,
+        'group': device.group or '交换机'
+    }
+
+def normalize_commands_field(commands):
+    """保存设备前规范化commands字段：JSON数组转换为逗号分隔的字符串"""
+    try:
+        if isinstance(commands, str) and commands.startswith('[') and commands.endswith(']'):
+            commands_list = json.loads(commands)
+            commands = ','.join([str(cmd).strip() for cmd in commands_list if cmd])
+    except Exception:
+        # 如果解析失败，保持原样
+        pass
+    return commands
+
+def parse_device_commands(raw_commands):
+    """解析设备的巡检命令字符串（JSON数组或逗号分隔）并清理"""
+    raw_commands = raw_commands or ''
+    if raw_commands.startswith('[') and raw_commands.endswith(']'):
+        try:
+            commands_list = json.loads(raw_commands)
+            commands = [str(cmd).strip() for cmd in commands_list if cmd]
+        except Exception as e:
+            logger.error(f"解析命令JSON失败: {e}")
+            commands = [cmd.strip() for cmd in raw_commands.split(',') if cmd.strip()]
+    else:
+        commands = [cmd.strip() for cmd in raw_commands.split(',') if cmd.strip()]
+
+    # 清理命令
+    cleaned_commands = []
+    for cmd in commands:
+        cmd = cmd.replace('"', '').replace("'", '')
+        cmd = cmd.replace('[', '').replace(']', '')
+        cmd = cmd.strip()
+        if cmd:
+            cleaned_commands.append(cmd)
+    return cleaned_commands
+
+# 编译后的巡检命令计划，commands为不可变的命令元组，digest为命令内容摘要
+CommandPlan = namedtuple('CommandPlan', ['commands', 'digest'])
+
+class CommandPlanCache:
+    """巡检命令计划缓存
+
+    设备的commands字段只在首次巡检或被修改后解析一次；
+    命令内容相同的设备共享同一个CommandPlan对象。
+    """
+
+    def __init__(self, max_plans=1024):
+        self.max_plans = max_plans
+        self.plans = OrderedDict()  # 命令原文 -> CommandPlan，按最近使用排序
+        self.plans_by_digest = {}  # 命令摘要 -> CommandPlan
+        self.device_plans = {}  # 设备ID -> (命令原文, CommandPlan)
+        self.lock = threading.Lock()
+
+    def get(self, device_id, raw_commands):
+        """返回设备的命令计划，命令原文未变化时直接使用缓存"""
+        with self.lock:
+            entry = self.device_plans.get(device_id)
+            if entry and entry[0] == raw_commands:
+                return entry[1]
+        plan = self.compile(raw_commands)
+        with self.lock:
+            self.device_plans[device_id] = (raw_commands, plan)
+        return plan
+
+    def compile(self, raw_commands):
+        """将命令原文编译为命令计划，没有有效命令时抛出ValueError"""
+        with self.lock:
+            plan = self.plans.get(raw_commands)
+            if plan:
+                self.plans.move_to_end(raw_commands)
+                return plan
+
+        commands = tuple(parse_device_commands(raw_commands))
+        if not commands:
+            raise ValueError('未配置有效的巡检命令')
+        digest = hashlib.sha1('\n'.join(commands).encode('utf-8')).hexdigest()
+
+        with self.lock:
+            # 写法不同但内容相同的命令（JSON数组/逗号分隔）共享同一个计划
+            plan = self.plans_by_digest.setdefault(digest, CommandPlan(commands, digest))
+            self.plans[raw_commands] = plan
+            while len(self.plans) > self.max_plans:
+                self.plans.popitem(last=False)
+            if len(self.plans_by_digest) > self.max_plans:
+                live_digests = set(item.digest for item in self.plans.values())
+                self.plans_by_digest = {key: value for key, value in self.plans_by_digest.items() if key in live_digests}
+        return plan
+
+    def invalidate(self, device_id=None):
+        """设备被添加、修改或删除后清除其缓存，不指定设备时清空全部"""
+        with self.lock:
+            if device_id is None:
+                self.device_plans.clear()
+            else:
+                self.device_plans.pop(device_id, None)
+
+command_plans = CommandPlanCache()
+
+# 巡检输出解析 - 按(设备类型, 命令)选择解析器，把输出转换为数值指标
+class OutputParserRegistry:
+    """输出解析器注册表
+
+    解析器接收命令输出，返回{指标名: 数值}；device_types为None时适用于所有设备类型。
+    同一(设备类型, 命令)匹配到的解析器列表会被缓存。
+    """
+
+    def __init__(self):
+        self.parsers = []  # (设备类型集合或None, 命令正则, 解析函数)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def register(self, command_pattern, device_types=None):
+        def decorator(parser):
+            with self.lock:
+                self.parsers.append((
+                    frozenset(device_types) if device_types else None,
+                    re.compile(command_pattern, re.IGNORECASE),
+                    parser
+                ))
+                self.cache.clear()
+            return parser
+        return decorator
+
+    def parsers_for(self, device_type, command):
+        key = (device_type, command)
+        with self.lock:
+            parsers = self.cache.get(key)
+            if parsers is None:
+                parsers = [
+                    parser for device_types, pattern, parser in self.parsers
+                    if (device_types is None or device_type in device_types) and pattern.search(command)
+                ]
+                self.cache[key] = parsers
+        return parsers
+
+    def parse(self, device_type, command, output):
+        """解析命令输出，解析失败只记录日志"""
+        metrics = {}
+        for parser in self.parsers_for(device_type, command):
+            try:
+                metrics.update(parser(output) or {})
+            except Exception as e:
+                logger.warning(f"解析命令 {command} 的输出失败: {str(e)}")
+        return metrics
+
+output_parsers = OutputParserRegistry()
+
+PERCENT_PATTERN = r'(\d+(?:\.\d+)?)\s*%'
+
+@output_parsers.register(r'cpu')
+def parse_cpu_usage(output):
+    # Huawei/H3C: CPU Usage : 6% / CPU utilization for five seconds: 6%
+    # Cisco: CPU utilization for five seconds: 5%/0%；Ruijie: CPU utilization in five seconds: 5.20%
+    match = re.search(r'CPU\s+(?:usage|utilization)[^\n%]*?[:：]\s*' + PERCENT_PATTERN, output, re.IGNORECASE)
+    if match:
+        return {'cpu_usage': float(match.group(1))}
+
+@output_parsers.register(r'mem')
+def parse_memory_usage(output):
+    match = re.search(
+        r'Memory\s+(?:utilization|usage|using\s+percentage|used\s+rate)[^\n%]*?[:：]?\s*' + PERCENT_PATTERN,
+        output, re.IGNORECASE
+    )
+    if match:
+        return {'memory_usage': float(match.group(1))}
+    # Cisco show processes memory: Processor Pool Total: 123456 Used: 23456 Free: ...
+    match = re.search(r'Total:\s*(\d+)\s+Used:\s*(\d+)', output)
+    if match and int(match.group(1)):
+        return {'memory_usage': round(int(match.group(2)) * 100.0 / int(match.group(1)), 2)}
+
+@output_parsers.register(r'^display\s+interface\s+brief', device_types=('huawei', 'hp_comware'))
+def parse_huawei_interface_brief(output):
+    # Interface  PHY  Protocol ...，PHY列为up/down/*down(管理关闭)/^down(备份)
+    up = down = 0
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 3 or fields[0].lower() in ('interface', 'phy'):
+            continue
+        phy = fields[1].lower()
+        if phy.startswith('up'):
+            up += 1
+        elif phy.endswith('down'):
+            down += 1
+    if up or down:
+        return {'interfaces_up': up, 'interfaces_down': down}
+
+@output_parsers.register(r'^show\s+ip\s+interface\s+brief', device_types=('cisco_ios', 'ruijie_os'))
+def parse_cisco_interface_brief(output):
+    # Interface  IP-Address  OK?  Method  Status  Protocol，Status为up/down/administratively down
+    up = down = 0
+    for line in output.splitlines():
+        match = re.match(r'^\S+\s+\S+\s+\S+\s+\S+\s+(administratively down|up|down)\s+(?:up|down)', line.strip())
+        if not match:
+            continue
+        if match.group(1) == 'up':
+            up += 1
+        else:
+            down += 1
+    if up or down:
+        return {'interfaces_up': up, 'interfaces_down': down}
+
+@output_parsers.register(r'temperature|environment')
+def parse_temperature(output):
+    # 表格形式（Huawei display temperature）取Current(C)列，否则取带温度单位的数值
+    temperatures = []
+    current_column = None
+    for line in output.splitlines():
+        fields = line.split()
+        if current_column is None:
+            for index, field in enumerate(fields):
+                if field.lower().startswith('current'):
+                    current_column = index
+            if current_column is not None:
+                continue
+        if current_column is not None and len(fields) > current_column:
+            try:
+                temperatures.append(float(fields[current_column]))
+            except ValueError:
+                pass
+    if not temperatures:
+        temperatures = [
+            float(value) for value in
+            re.findall(r'(-?\d+(?:\.\d+)?)\s*(?:C\b|℃|degrees)', output, re.IGNORECASE)
+        ]
+    if temperatures:
+        return {'temperature_max': max(temperatures)}
+
+# 健康检查 - 规则编译一次后缓存，每条新巡检记录只执行适用于该设备的规则
+HEALTH_RULE_OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+HEALTH_SEVERITIES = ('警告', '严重')
+
+# 编译后的健康规则，check(command_results)返回异常描述列表
+CompiledHealthRule = namedtuple('CompiledHealthRule', ['id', 'name', 'severity', 'group', 'device_type', 'check'])
+
+def compile_health_rule(rule):
+    """将规则编译为检查函数，正则表达式无效时抛出ValueError"""
+    if rule.rule_type == 'threshold':
+        compare = HEALTH_RULE_OPERATORS[rule.operator]
+        rule_metric, rule_threshold, rule_operator, rule_name = rule.metric, rule.threshold, rule.operator, rule.name
+
+        def check(command_results):
+            values = {}
+            for item in command_results:
+                values.update(item.get('metrics') or {})
+            value = values.get(rule_metric)
+            if value is not None and compare(value, rule_threshold):
+                return [f"{rule_name}: {rule_metric}={value:g} {rule_operator} {rule_threshold:g}"]
+            return []
+    else:
+        try:
+            command_regex = re.compile(rule.command_pattern, re.IGNORECASE) if rule.command_pattern else None
+            output_regex = re.compile(rule.pattern, re.MULTILINE)
+        except re.error as e:
+            raise ValueError(f'正则表达式无效: {str(e)}')
+        expect_present = rule.match == 'present'
+        rule_name = rule.name
+
+        def check(command_results):
+            findings = []
+            for item in command_results:
+                if command_regex and not command_regex.search(item['command']):
                     continue
-        
-        # 准备发送ZIP文件
-        memory_file.seek(0)
-        timestamp = datetime.now(tz).strftime("%Y%m%d_%H%M%S")
-        
-        return send_file(
-            memory_file,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'inspection_records_{timestamp}.zip'
-        )
-    except Exception as e:
-        logger.error(f"批量导出巡检记录失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+                match = output_regex.search(item['output'] or '')
+                if expect_present and match:
+                    findings.append(f"{rule_name}: 命令 {item['command']} 输出包含 {match.group(0).strip()}")
+                elif not expect_present and not match:
+                    findings.append(f"{rule_name}: 命令 {item['command']} 输出中未找到 {output_regex.pattern}")
+            return findings
+
+    return CompiledHealthRule(rule.id, rule.name, rule.severity, rule.group, rule.device_type, check)
+
+class HealthRuleSet:
+    """已编译的健康规则
+
+    规则增删改后调用invalidate，下次检查时重新加载并编译全部启用的规则；
+    每个(分组, 设备类型)适用的规则列表只筛选一次。
+    """
+
+    def __init__(self):
+        self.rules = None
+        self.scoped = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.rules = None
+            self.scoped = {}
+
+    def rules_for(self, group, device_type):
+        with self.lock:
+            if self.rules is None:
+                rules = []
+                for rule in HealthRule.query.filter_by(enabled=True).order_by(HealthRule.id).all():
+                    try:
+                        rules.append(compile_health_rule(rule))
+                    except Exception as e:
+                        logger.error(f"编译健康规则 {rule.name} 失败: {str(e)}")
+                self.rules = rules
+            key = (group, device_type)
+            if key not in self.scoped:
+                self.scoped[key] = [
+                    rule for rule in self.rules
+                    if (not rule.group or rule.group == group) and (not rule.device_type or rule.device_type == device_type)
+                ]
+            return self.scoped[key]
+
+    def evaluate(self, device_info, command_results):
+        """返回 (结论, 异常项列表)，结论为正常/警告/严重"""
+        findings = []
+        verdict = '正常'
+        for rule in self.rules_for(device_info['group'], device_info['device_type']):
+            try:
+                messages = rule.check(command_results)
+            except Exception as e:
+                logger.error(f"执行健康规则 {rule.name} 失败: {str(e)}")
+                continue
+            if messages:
+                findings.extend({'rule_id': rule.id, 'severity': rule.severity, 'message': message} for message in messages)
+                if rule.severity == '严重' or verdict == '严重':
+                    verdict = '严重'
+                else:
+                    verdict = '警告'
+        return verdict, findings
+
+health_rules = HealthRuleSet()
+
+def run_device_commands(device_info, timeout=30):
+    """从连接池获取设备会话并依次执行巡检命令，返回 (命令是否全部成功, 命令结果列表)"""
+    device_type = get_device_type(device_info['device_type'], device_info['protocol'])
+    logger.info(f"开始巡检设备: {device_info['name']} ({device_info['ip']}), 设备类型: {device_type}")
+
+    # 连接参数
+    connection_params = {
+        'device_type': device_type,
+        'host': device_info['ip'],
+        'username': device_info['username'],
+        'password': device_info['password'],
+        'timeout': timeout,
+        'auth_timeout': timeout,
+        'banner_timeout': timeout,
+        'fast_cli': False,
+        'session_log': None  # 关闭会话日志以减少干扰
+    }
+
+    enable_password = device_info['enable_password']
+    if enable_password and enable_password.strip():
+        connection_params['secret'] = enable_password
+
+    def setup_connection(connection):
+        # 处理enable模式，复用的会话已经处于enable模式
+        if 'cisco_ios' in device_type and enable_password and enable_password.strip():
+            connection.enable()
+            logger.info(f"设备 {device_info['ip']} 进入enable模式")
+        elif 'ruijie_os' in device_type:
+            logger.info(f"锐捷交换机设备 {device_info['ip']} 不需要进入 enable 模式，跳过此步骤")
+
+    plan = command_plans.get(device_info['id'], device_info['commands'])
+    logger.info(f"设备 {device_info['ip']} 执行命令列表: {list(plan.commands)}")
+
+    connection = connection_pool.acquire(device_info['id'], connection_params, setup_connection)
+    command_success = False
+    try:
+
+        # 执行命令
+        command_success = True
+        command_results = []
+        for cmd in plan.commands:
+            try:
+                logger.info(f"设备 {device_info['ip']} 执行命令: {cmd}")
+                output = connection.send_command(cmd, strip_prompt=False, strip_command=False)
+                command_results.append({
+                    'command': cmd,
+                    'output': output,
+                    'metrics': output_parsers.parse(device_info['device_type'], cmd, output)
+                })
+                logger.info(f"设备 {device_info['ip']} 命令 {cmd} 执行成功")
+            except Exception as e:
+                logger.error(f"设备 {device_info['ip']} 执行命令 {cmd} 失败: {str(e)}")
+                command_success = False
+                command_results.append({
+                    'command': cmd,
+                    'output': f"执行命令失败: {str(e)}"
+                })
+    finally:
+        # 命令执行失败的会话状态不可信，直接断开
+        connection_pool.release(device_info['id'], connection, reusable=command_success)
+
+    return command_success, command_results
+
+class BatchInspectionProgress:
+    """批量巡检进度，多个巡检线程共享同一份计数
+
+    每台设备的进度保存在InspectionLogDevice中，更新时只修改对应的一行；
+    数据库写入交给db_writer，同时完成的多台设备在一个事务中提交。
+    """
+
+    def __init__(self, log_id, log_device_ids):
+        self.log_id = log_id
+        self.log_device_ids = log_device_ids
+        self.successful_count = 0
+        self.failed_count = 0
+        self.lock = threading.Lock()
+
+    def is_cancelled(self):
+        status = db.session.query(InspectionLog.status).filter_by(id=self.log_id).scalar()
+        return status == '已取消'
+
+    def start_device(self, idx):
+        self._update(idx, {
+            'status': '进行中',
+            'message': '正在巡检...',
+            'start_time': datetime.now(tz)
+        })
+
+    def finish_device(self, idx, success, message, duration=None, record=None, verdict=None, findings=None):
+        values = {
+            'status': '成功' if success else '失败',
+            'message': message,
+            'end_time': datetime.now(tz)
+        }
+        if duration is not None:
+            values['duration'] = duration
+        if verdict is not None:
+            values['verdict'] = verdict
+            values['findings'] = json.dumps(findings or [], ensure_ascii=False)
+        self._update(idx, values, record, 'successful_devices' if success else 'failed_devices')
+        # 写入提交后才计数，写入失败时调用方会把设备记为失败，不会重复计数
+        with self.lock:
+            if success:
+                self.successful_count += 1
+            else:
+                self.failed_count += 1
+
+    def _update(self, idx, values, record=None, counter=None):
+        device_detail, successful_count, failed_count = db_writer.write(self._write, idx, values, record, counter)
+        if device_detail is not None:
+            event_broker.publish('inspection_progress', {
+                'log_id': self.log_id,
+                'total_devices': len(self.log_device_ids),
+                'successful_devices': successful_count,
+                'failed_devices': failed_count,
+                'device': device_detail
+            })
+
+    def _write(self, idx, values, record, counter):
+        """写入任务：保存巡检记录，更新日志计数和设备进度
+
+        计数在数据库中递增，与记录在同一事务中提交，事务失败时计数也不会改变。
+        """
+        if record is not None:
+            db.session.add(record)
+        # 已取消的日志由取消接口更新设备状态，这里不再覆盖
+        log_query = InspectionLog.query.filter(InspectionLog.id == self.log_id, InspectionLog.status != '已取消')
+        if counter:
+            updated = log_query.update({counter: getattr(InspectionLog, counter) + 1}, synchronize_session=False)
+        else:
+            updated = log_query.count()
+        device_detail = None
+        successful_count = failed_count = None
+        if updated:
+            log_device = InspectionLogDevice.query.get(self.log_device_ids[idx])
+            for name, value in values.items():
+                setattr(log_device, name, value)
+            device_detail = log_device.to_dict()
+            successful_count, failed_count = db.session.query(
+                InspectionLog.successful_devices, InspectionLog.failed_devices
+            ).filter_by(id=self.log_id).one()
+        return device_detail, successful_count, failed_count
+
+def inspect_batch_device(progress, idx, device_info):
+    """在巡检线程中巡检单台设备"""
+    with app.app_context():
+        try:
+            # 开始前检查日志状态，如果已取消则不再巡检
+            if progress.is_cancelled():
+                return
+            progress.start_device(idx)
+
+            device_start_time = time.time()
+            command_success, command_results = run_device_commands(device_info)
+
+            record = InspectionRecord(device_id=device_info['id'], device_name=device_info['name'])
+            record.set_results(command_results, command_success)
+            diff_with_previous_record(record, command_results)
+            verdict, findings = health_rules.evaluate(device_info, command_results)
+            progress.finish_device(
+                idx,
+                command_success,
+                '巡检完成' if command_success else '部分命令执行失败',
+                duration=time.time() - device_start_time,
+                record=record,
+                verdict=verdict,
+                findings=findings
+            )
+            logger.info(f"设备 {device_info['ip']} 巡检完成，巡检记录已保存")
+        except Exception as e:
+            logger.error(f"设备 {device_info['ip']} 巡检过程中出错: {str(e)}")
+            db.session.rollback()
+            progress.finish_device(idx, False, f'巡检失败: {str(e)}')
+
+def interleave_by_group(devices_info):
+    """按分组轮转排列设备，避免同一分组的设备占满全局线程而互相等待"""
+    groups = {}
+    for idx, device_info in enumerate(devices_info):
+        groups.setdefault(device_info['group'], []).append((idx, device_info))
+    pending_groups = list(groups.values())
+    ordered = []
+    while pending_groups:
+        for group_devices in pending_groups:
+            ordered.append(group_devices.pop(0))
+        pending_groups = [group_devices for group_devices in pending_groups if group_devices]
+    return ordered
+
+class GroupDispatcher:
+    """按分组限制并发数，把任务提交到共享线程池
+
+    分组正在执行的任务数达到上限时，新任务留在该分组的等待队列中，不占用线程池的线程；
+    分组中有任务结束时再提交该分组的下一个任务。
+    """
+
+    def __init__(self, executor, group_limit):
+        self.executor = executor
+        self.group_limit = max(1, group_limit)
+        self.pending = {}  # 分组 -> 等待提交的 (future, fn, args)
+        self.running = {}  # 分组 -> 已提交到线程池的任务数
+        self.lock = threading.Lock()
+
+    def submit(self, group, fn, *args):
+        """提交任务，返回Future；任务开始前可以取消"""
+        future = Future()
+        with self.lock:
+            self.pending.setdefault(group, deque()).append((future, fn, args))
+        self._dispatch(group)
+        return future
+
+    def _dispatch(self, group):
+        while True:
+            with self.lock:
+                group_tasks = self.pending.get(group)
+                if not group_tasks or self.running.get(group, 0) >= self.group_limit:
+                    return
+                future, fn, args = group_tasks.popleft()
+                if not group_tasks:
+                    del self.pending[group]
+                # 已取消的任务直接丢弃
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running[group] = self.running.get(group, 0) + 1
+            self.executor.submit(self._run, group, future, fn, args)
+
+    def _run(self, group, future, fn, args):
+        try:
+            result = fn(*args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                self.running[group] -= 1
+                if not self.running[group]:
+                    del self.running[group]
+            self._dispatch(group)
+
+# 批量巡检任务在后台线程中运行，所有任务共享同一个设备巡检线程池和分组调度器，
+# 因此全局并发数和分组并发数对同时运行的多个任务同样有效
+batch_job_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_MAX_JOBS'], thread_name_prefix='batch-job')
+batch_device_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_MAX_WORKERS'], thread_name_prefix='batch-device')
+batch_group_dispatcher = GroupDispatcher(batch_device_executor, app.config['BATCH_GROUP_MAX_WORKERS'])
+
+def run_batch_inspection(log_id, devices_info, log_device_ids):
+    """并发巡检一批设备，返回 (成功数, 失败数)"""
+    progress = BatchInspectionProgress(log_id, log_device_ids)
+    futures = [
+        batch_group_dispatcher.submit(device_info['group'], inspect_batch_device, progress, idx, device_info)
+        for idx, device_info in interleave_by_group(devices_info)
+    ]
+    for future in as_completed(futures):
+        if future.cancelled():
+            continue
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"巡检任务 {log_id} 的巡检线程异常退出: {str(e)}")
+        if progress.is_cancelled():
+            # 取消尚未开始的设备，正在巡检的设备会自然结束
+            for pending in futures:
+                pending.cancel()
+
+    return progress.successful_count, progress.failed_count
+
+def publish_inspection_finished(summary):
+    """推送巡检任务结束事件，summary为InspectionLog.to_summary_dict()"""
+    event_broker.publish('inspection_finished', {
+        'log_id': summary['id'],
+        'status': summary['status'],
+        'total_devices': summary['total_devices'],
+        'successful_devices': summary['successful_devices'],
+        'failed_devices': summary['failed_devices'],
+        'total_duration': summary['total_duration']
+    })
+
+def finish_batch_log(log_id, total_duration):
+    """写入任务：标记巡检日志结束，返回日志摘要"""
+    inspection_log = InspectionLog.query.get(log_id)
+    if not inspection_log:
+        return None
+    inspection_log.end_time = datetime.now(tz)
+    if inspection_log.status != '已取消':
+        inspection_log.status = '已完成'
+    inspection_log.total_duration = total_duration
+    return inspection_log.to_summary_dict()
+
+def run_batch_job(log_id, devices_info, log_device_ids):
+    """后台执行批量巡检任务，并在结束时更新巡检日志"""
+    with app.app_context():
+        start_time = time.time()
+        try:
+            successful_count, failed_count = run_batch_inspection(log_id, devices_info, log_device_ids)
+            logger.info(f"批量巡检任务 {log_id} 已完成，成功: {successful_count}，失败: {failed_count}")
+        except Exception as e:
+            logger.error(f"批量巡检任务 {log_id} 发生未处理的异常: {str(e)}")
+            db.session.rollback()
+        finally:
+            try:
+                # 完成所有设备巡检
+                summary = db_writer.write(finish_batch_log, log_id, time.time() - start_time)
+                if summary:
+                    publish_inspection_finished(summary)
+            except Exception as e:
+                logger.error(f"更新巡检日志失败: {str(e)}")
+
+def cancel_log_devices(inspection_log, message):
+    """将巡检日志中等待中和进行中的设备标记为已取消"""
+    now = datetime.now(tz)
+    if inspection_log.details:
+        # 旧版本的日志
+        device_details = json.loads(inspection_log.details)
+        for detail in device_details:
+            if detail['status'] in ['进行中', '等待中']:
+                detail['status'] = '已取消'
+                detail['message'] = message
+                detail['end_time'] = now.isoformat()
+        inspection_log.details = json.dumps(device_details)
+    InspectionLogDevice.query.filter(
+        InspectionLogDevice.log_id == inspection_log.id,
+        InspectionLogDevice.status.in_(['进行中', '等待中'])
+    ).update({'status': '已取消', 'message': message, 'end_time': now}, synchronize_session=False)
+
+def recover_interrupted_inspections():
+    """服务重启后，将上次未完成的巡检日志标记为已取消"""
+    interrupted_logs = InspectionLog.query.filter_by(status='进行中').all()
+    for inspection_log in interrupted_logs:
+        inspection_log.status = '已取消'
+        inspection_log.end_time = inspection_log.end_time or datetime.now(tz)
+        cancel_log_devices(inspection_log, '服务重启，巡检中断')
+    if interrupted_logs:
+        db.session.commit()
+        logger.warning(f"已将 {len(interrupted_logs)} 个中断的巡检任务标记为已取消")
+
+with app.app_context():
+    recover_interrupted_inspections()
 
-# 批量巡检API - 保持简单实现
+# 批量巡检API - 创建巡检日志后立即返回，巡检在后台执行
 @app.route('/api/devices/batch-inspect', methods=['POST'])
 def batch_inspect_devices():
     data = request.json
@@ -791,204 +3525,101 @@ def batch_inspect_devices():
                 'message': '所选设备中没有在线设备，无法进行巡检'
             }), 400
         
-        # 创建巡检日志
-        device_details = []
-        for device in devices:
-            device_details.append({
-                'device_id': device.id,
-                'device_name': device.name,
-                'device_ip': device.ip,
-                'status': '等待中',
-                'message': '等待巡检...',
-                'start_time': None,
-                'end_time': None
-            })
-        
+        # 创建巡检日志，每台设备一行进度记录
         inspection_log = InspectionLog(
             total_devices=len(devices),
             status='进行中',
-            details=json.dumps(device_details)
+            devices=[InspectionLogDevice(
+                position=idx,
+                device_id=device.id,
+                device_name=device.name,
+                device_ip=device.ip,
+                status='等待中',
+                message='等待巡检...'
+            ) for idx, device in enumerate(devices)]
         )
         db.session.add(inspection_log)
         db.session.commit()
+        log_device_ids = [log_device.id for log_device in inspection_log.devices]
         
-        # 执行巡检
-        results = []
-        successful_count = 0
-        failed_count = 0
-        start_time = time.time()
-        
-        for idx, device in enumerate(devices):
+        # 提交后台巡检任务
+        # 按命令模板分组，相同模板的设备共享同一个命令计划
+        resolver = CommandProfileResolver()
+        devices_info = [device_snapshot(device, resolver) for device in devices]
+        for raw_commands in set(device_info['commands'] for device_info in devices_info):
             try:
-                # 重新检查日志状态，如果已取消则中止执行
-                current_log = InspectionLog.query.get(inspection_log.id)
-                if current_log.status == '已取消':
-                    logger.info(f"巡检任务 {inspection_log.id} 被用户取消")
-                    break
-                    
-                # 更新当前设备状态
-                device_details = json.loads(inspection_log.details)
-                device_details[idx]['status'] = '进行中'
-                device_details[idx]['message'] = '正在巡检...'
-                device_details[idx]['start_time'] = datetime.now(tz).isoformat()
-                inspection_log.details = json.dumps(device_details)
-                db.session.commit()
-                
-                # 获取设备类型
-                device_type = get_device_type(device.device_type, device.protocol)
-                logger.info(f"开始巡检设备: {device.name} ({device.ip}), 设备类型: {device_type}")
-                
-                # 连接参数
-                connection_params = {
-                    'device_type': device_type,
-                    'host': device.ip,
-                    'username': device.username,
-                    'password': device.password,
-                    'timeout': 30,  # 增加超时时间
-                    'auth_timeout': 30,
-                    'banner_timeout': 30,
-                    'fast_cli': False,
-                    'session_log': None  # 关闭会话日志以减少干扰
-                }
-                
-                if device.enable_password and device.enable_password.strip():
-                    connection_params['secret'] = device.enable_password
-                
-                # 连接设备
-                device_start_time = time.time()
-                logger.info(f"尝试连接设备: {device.ip}")
-                
-                connection = netmiko.ConnectHandler(**connection_params)
-                logger.info(f"成功连接到设备: {device.ip}")
-                
-                # 处理enable模式
-                if 'cisco_ios' in device_type and device.enable_password and device.enable_password.strip():
-                    connection.enable()
-                    logger.info(f"设备 {device.ip} 进入enable模式")
-                
-                # 处理命令
-                command_success = True  # 添加命令执行状态跟踪
-                command_results = []  # 添加command_results变量定义
-                if device.commands.startswith('[') and device.commands.endswith(']'):
-                    try:
-                        commands_list = json.loads(device.commands)
-                        commands = [str(cmd).strip() for cmd in commands_list if cmd]
-                    except Exception as e:
-                        logger.error(f"解析命令JSON失败: {e}")
-                        commands = [cmd.strip() for cmd in device.commands.split(',') if cmd.strip()]
-                else:
-                    commands = [cmd.strip() for cmd in device.commands.split(',') if cmd.strip()]
-                
-                # 清理命令
-                cleaned_commands = []
-                for cmd in commands:
-                    cmd = cmd.replace('"', '').replace("'", '')
-                    cmd = cmd.replace('[', '').replace(']', '')
-                    cmd = cmd.strip()
-                    if cmd:
-                        cleaned_commands.append(cmd)
-                
-                logger.info(f"设备 {device.ip} 执行命令列表: {cleaned_commands}")
-                
-                # 执行命令
-                for cmd in cleaned_commands:
-                    try:
-                        logger.info(f"设备 {device.ip} 执行命令: {cmd}")
-                        output = connection.send_command(cmd, strip_prompt=False, strip_command=False)
-                        command_results.append({
-                            'command': cmd,
-                            'output': output
-                        })
-                        logger.info(f"设备 {device.ip} 命令 {cmd} 执行成功")
-                    except Exception as e:
-                        logger.error(f"设备 {device.ip} 执行命令 {cmd} 失败: {str(e)}")
-                        command_success = False
-                        command_results.append({
-                            'command': cmd,
-                            'output': f"执行命令失败: {str(e)}"
-                        })
-                
-                # 断开连接
-                try:
-                    connection.disconnect()
-                    logger.info(f"设备 {device.ip} 断开连接")
-                except Exception as e:
-                    logger.warning(f"断开设备 {device.ip} 连接时出错: {str(e)}")
-                
-                # 保存巡检记录
-                record = InspectionRecord(
-                    device_id=device.id,
-                    device_name=device.name,
-                    result=json.dumps(command_results, ensure_ascii=False)
-                )
-                db.session.add(record)
-                db.session.commit()
-                logger.info(f"设备 {device.ip} 巡检记录已保存")
-                
-                # 更新设备巡检状态
-                device_details = json.loads(inspection_log.details)
-                device_details[idx]['status'] = '成功' if command_success else '失败'
-                device_details[idx]['message'] = '巡检完成' if command_success else error_msg
-                device_details[idx]['end_time'] = datetime.now(tz).isoformat()
-                device_details[idx]['duration'] = time.time() - device_start_time
-                
-                successful_count += 1 if command_success else 0
-                failed_count += 1 if not command_success else 0
-                logger.info(f"设备 {device.ip} 巡检完成")
-                
-            except Exception as e:
-                logger.error(f"设备 {device.ip} 巡检过程中出错: {str(e)}")
-                # 更新设备巡检状态
-                device_details = json.loads(inspection_log.details)
-                device_details[idx]['status'] = '失败'
-                device_details[idx]['message'] = f'巡检失败: {str(e)}'
-                device_details[idx]['end_time'] = datetime.now(tz).isoformat()
-                
-                failed_count += 1
-            
-            # 更新巡检日志
-            inspection_log.successful_devices = successful_count
-            inspection_log.failed_devices = failed_count
-            inspection_log.details = json.dumps(device_details)
-            db.session.commit()
-        
-        # 完成所有设备巡检
-        inspection_log.end_time = datetime.now(tz)
-        if inspection_log.status != '已取消':
-            inspection_log.status = '已完成'
-        inspection_log.total_duration = time.time() - start_time
-        db.session.commit()
-        logger.info(f"批量巡检任务 {inspection_log.id} 已完成，成功: {successful_count}，失败: {failed_count}")
+                command_plans.compile(raw_commands)
+            except ValueError:
+                pass
+        batch_job_executor.submit(
+            run_batch_job, inspection_log.id, devices_info, log_device_ids
+        )
+        logger.info(f"批量巡检任务 {inspection_log.id} 已提交，共 {len(devices)} 台设备")
         
         return jsonify({
             'success': True,
-            'message': f'批量巡检已完成，成功: {successful_count}，失败: {failed_count}',
+            'message': f'批量巡检任务已提交，共 {len(devices)} 台设备',
             'log_id': inspection_log.id
         })
     except Exception as e:
-        logger.error(f"批量巡检过程中发生未处理的异常: {str(e)}")
-        # 如果已创建日志，则更新日志状态
-        if 'inspection_log' in locals():
-            try:
-                inspection_log.end_time = datetime.now(tz)
-                inspection_log.status = '已完成'  # 标记为已完成但失败
-                inspection_log.total_duration = time.time() - start_time
-                db.session.commit()
-            except Exception as inner_e:
-                logger.error(f"更新巡检日志失败: {str(inner_e)}")
-                db.session.rollback()
-        
+        logger.error(f"提交批量巡检任务失败: {str(e)}")
+        db.session.rollback()
         return jsonify({
             'success': False,
             'message': f'批量巡检过程中出错: {str(e)}'
         }), 500
 
 # 巡检日志API
+def parse_time_arg(args, name):
+    """解析ISO格式的时间查询参数"""
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name}参数不是有效的时间格式: {value}')
+
+def parse_number_arg(args, name):
+    """解析数值查询参数"""
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f'{name}参数不是有效的数值: {value}')
+
 @app.route('/api/inspection-logs', methods=['GET'])
 def get_inspection_logs():
+    """巡检日志摘要列表，不包含设备详情；带page/per_page参数时分页返回"""
     try:
-        logs = InspectionLog.query.order_by(InspectionLog.start_time.desc()).all()
-        return jsonify([log.to_dict() for log in logs])
+        query = InspectionLog.query.options(defer(InspectionLog.details))
+        if request.args.get('status'):
+            query = query.filter(InspectionLog.status == request.args['status'])
+        start = parse_time_arg(request.args, 'start')
+        if start:
+            query = query.filter(InspectionLog.start_time >= start)
+        end = parse_time_arg(request.args, 'end')
+        if end:
+            query = query.filter(InspectionLog.start_time < end)
+        query = query.order_by(InspectionLog.start_time.desc())
+
+        if 'page' not in request.args and 'per_page' not in request.args:
+            return jsonify([log.to_summary_dict() for log in query.all()])
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 200)
+        total = query.order_by(None).count()
+        logs = query.offset((page - 1) * per_page).limit(per_page).all()
+        return jsonify({
+            'items': [log.to_summary_dict() for log in logs],
+            'total': total,
+            'page': page,
+            'per_page': per_page
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"获取巡检日志失败: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -1031,15 +3662,9 @@ def cancel_inspection(log_id):
         inspection_log.end_time = datetime.now(tz)
         
         # 更新设备巡检状态
-        device_details = json.loads(inspection_log.details) if inspection_log.details else []
-        for detail in device_details:
-            if detail['status'] in ['进行中', '等待中']:
-                detail['status'] = '已取消'
-                detail['message'] = '用户取消巡检'
-                detail['end_time'] = datetime.now(tz).isoformat()
-        
-        inspection_log.details = json.dumps(device_details)
+        cancel_log_devices(inspection_log, '用户取消巡检')
         db.session.commit()
+        publish_inspection_finished(inspection_log.to_summary_dict())
         
         return jsonify({
             'success': True,
@@ -1050,6 +3675,17 @@ def cancel_inspection(log_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    """服务健康检查，返回启动各阶段耗时，启动脚本用于判断服务是否就绪"""
+    return jsonify({
+        'status': 'ok',
+        'startup_timings': [{'stage': stage, 'seconds': seconds} for stage, seconds in startup_timings.items()]
+    })
+
+mark_startup_stage('加载完成')
+logger.info("启动耗时: " + "，".join(f"{stage} {seconds:.3f} 秒" for stage, seconds in startup_timings.items()))
+
 if __name__ == '__main__':
     logger.info("启动华巡巡检系统后端服务")
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -36,22 +36,27 @@ REM 启动后端服务
 echo 正在启动后端服务...
 start "Huaxuncheck Backend" %PYTHON_CMD% app.py
 
-REM 等待后端服务启动
+REM 等待后端服务启动，服务就绪后立即继续，最多等待30秒
 echo 等待后端服务启动...
-timeout /t 5
+set /a WAIT_COUNT=0
+:wait_backend
+curl -s http://localhost:5000/api/health >nul 2>&1
+if not errorlevel 1 goto backend_ready
+set /a WAIT_COUNT+=1
+if %WAIT_COUNT% geq 30 goto backend_failed
+timeout /t 1 /nobreak >nul
+goto wait_backend
 
-REM 检查后端服务是否正常运行
-curl http://localhost:5000/api/devices >nul 2>&1
-if errorlevel 1 (
-    echo 错误：后端服务启动失败
-    echo 请检查：
-    echo 1. 端口5000是否被占用
-    echo 2. 查看命令行窗口中的错误信息
-    echo 3. 确保所有依赖都已正确安装
-    pause
-    exit /b 1
-)
+:backend_failed
+echo 错误：后端服务启动失败
+echo 请检查：
+echo 1. 端口5000是否被占用
+echo 2. 查看命令行窗口中的错误信息
+echo 3. 确保所有依赖都已正确安装
+pause
+exit /b 1
 
+:backend_ready
 REM 启动前端页面
 echo 正在启动前端页面...
 start frontend/index.html